@@ -1,19 +1,112 @@
+import glob
+import hashlib
+import json
 import os
 import sys
-from typing import Tuple, Iterable
-
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, wraps
+from itertools import chain
+from typing import Tuple, Iterable, List, Mapping
+
+from appdirs import user_cache_dir
+from diskcache import Cache, Lock
+from diskcache.core import ENOVAL
 from loguru import logger
 import mygene
-from genomepy.provider import ProviderBase, cached
+import genomepy
+from genomepy.provider import ProviderBase
 from genomepy import Genome
+import numpy as np
 import pandas as pd
 
 
 logger.remove()
 logger.add(sys.stderr, format="<green>{time:YYYY-MM-DD at HH:mm:ss}</green> <bold>|</bold> <blue>{level}</blue> <bold>|</bold> {message}", level="INFO")
 
+# Persistent cache of the remote lookups, shared by all processes on this machine
+# (diskcache is backed by SQLite and safe to use from concurrent jobs).
+# Entries expire after CACHE_EXPIRE seconds, and the least recently used entries
+# are evicted when the cache grows beyond CACHE_SIZE bytes.
+CACHE_DIR = os.path.join(user_cache_dir("gene_annotation"), genomepy.__version__)
+CACHE_EXPIRE = 7 * 24 * 3600
+CACHE_SIZE = 2 ** 30
+disk_cache = Cache(
+    directory=CACHE_DIR,
+    size_limit=CACHE_SIZE,
+    eviction_policy="least-recently-used",
+)
+
+# Gene indexes of the local annotations, see gene_index()
+INDEX_DIR = os.path.join(CACHE_DIR, "gene_index")
+
+# Chromosome alias tables of the NCBI assemblies, see chrom_alias_table()
+ALIAS_DIR = os.path.join(CACHE_DIR, "chrom_alias")
+
+# mygene.info is queried with MYGENE_CHUNKSIZE genes per request, with at most
+# MYGENE_THREADS requests at the same time. Failed requests are retried
+# MYGENE_RETRIES times, waiting MYGENE_BACKOFF seconds and doubling every retry.
+MYGENE_CHUNKSIZE = 1000
+MYGENE_THREADS = 4
+MYGENE_RETRIES = 3
+MYGENE_BACKOFF = 1.0
+
+
+@lru_cache(maxsize=None)
+def load_genome(genome_name: str) -> Genome:
+    """Return a local genome, every genome is only loaded once per process."""
+    return Genome(genome_name)
+
+
+def _genome_key(genome_name: str) -> Tuple[str, str, str]:
+    """Cache key of a genome: the name, and the assembly accession and provider
+    if it is installed locally. So results are not reused after a genome is
+    reinstalled from another assembly or provider.
+    """
+    try:
+        g = load_genome(genome_name)
+    except FileNotFoundError:
+        return genome_name, None, None
+    return genome_name, g.assembly_accession, g.provider
+
+
+def cached(key=None, expire=CACHE_EXPIRE):
+    """Cache the result of a function in the persistent disk cache.
+
+    Only one process computes a missing entry, concurrent calls with the same
+    key wait for it and read the result from the cache.
+
+    Parameters
+    ----------
+    key : function, optional
+        Function of the arguments that returns the cache key. By default the
+        arguments themselves are the key.
+    expire : int, optional
+        Seconds after which an entry expires.
+    """
 
-#@cached
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args):
+            cache_key = (func.__qualname__,) + tuple(key(*args) if key else args)
+            result = disk_cache.get(cache_key, default=ENOVAL, retry=True)
+            if result is not ENOVAL:
+                return result
+
+            with Lock(disk_cache, ("lock",) + cache_key, expire=3600):
+                # another process may have filled it while we waited for the lock
+                result = disk_cache.get(cache_key, default=ENOVAL, retry=True)
+                if result is ENOVAL:
+                    result = func(*args)
+                    disk_cache.set(cache_key, result, expire=expire, retry=True)
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+@cached(key=_genome_key)
 def ensembl_genome_info(genome_name: str) -> Tuple[str, str, str]:
     """Return Ensembl genome information for a local genome managed by genomepy.
 
@@ -38,7 +131,7 @@ def ensembl_genome_info(genome_name: str) -> Tuple[str, str, str]:
         search_term = common_names[genome_name]
     else:
         try:
-            genome = Genome(genome_name)
+            genome = load_genome(genome_name)
             search_term = genome.tax_id
         except FileNotFoundError:
             logger.info(f"Genome {genome_name} not installed locally")
@@ -66,7 +159,7 @@ def ensembl_genome_info(genome_name: str) -> Tuple[str, str, str]:
         return None
 
 
-#@cached
+@cached()
 def ncbi_assembly_report(asm_acc: str) -> pd.DataFrame:
     """Retrieve the NCBI assembly report as a DataFrame.
 
@@ -112,39 +205,257 @@ def ncbi_assembly_report(asm_acc: str) -> pd.DataFrame:
     return asm_report
 
 
-#@cached
-def load_mapping(genome_name):
-    logger.info("Loading chromosome mapping.")
-    genome = Genome(genome_name)
-    asm_acc = genome.assembly_accession
+@lru_cache(maxsize=None)
+def chrom_alias_table(asm_acc: str) -> pd.DataFrame:
+    """Return the chromosome alias table of an NCBI assembly.
+
+    The table is built once per assembly from the NCBI assembly report and
+    stored on disk, so genomes of the same assembly share it.
+
+    Parameters
+    ----------
+    asm_acc : str
+        Assembly accession (GCA or GCF)
+
+    Returns
+    -------
+    pandas.DataFrame
+        Indexed by every name of a sequence (NCBI, UCSC, GenBank and RefSeq
+        names, and the chromosome for assembled molecules), with the NCBI and
+        UCSC name of the sequence as categorical columns.
+    """
+    fname = os.path.join(ALIAS_DIR, f"{asm_acc}.npy")
+    if not os.path.exists(fname):
+        asm_report = ncbi_assembly_report(asm_acc)
+        asm_report.loc[
+            asm_report["Sequence-Role"] != "assembled-molecule", "Assigned-Molecule"
+        ] = "na"
+        names = asm_report[["Sequence-Name", "UCSC-style-name"]].astype(str)
+
+        alias_columns = [
+            "Sequence-Name",
+            "UCSC-style-name",
+            "Assigned-Molecule",
+            "GenBank-Accn",
+            "RefSeq-Accn",
+        ]
+        aliases = pd.concat([asm_report[col].astype(str) for col in alias_columns])
+        aliases = aliases[aliases != "na"]
+        aliases = aliases[~aliases.duplicated()]
+        table = names.loc[aliases.index].set_axis(aliases.values)
+
+        os.makedirs(ALIAS_DIR, exist_ok=True)
+        tmp = f"{fname}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            # columns alias, NCBI name, UCSC name
+            np.save(f, table.reset_index().to_numpy().astype(str))
+        os.replace(tmp, fname)
+
+    aliases, ncbi, ucsc = np.load(fname).T
+    table = pd.DataFrame(
+        {
+            "NCBI": pd.Categorical(ncbi),
+            # sequences without an UCSC name are missing
+            "UCSC": pd.Categorical(ucsc, categories=np.unique(ucsc[ucsc != "na"])),
+        },
+        index=pd.Index(aliases),
+    )
+    return table
+
+
+def load_mapping(genome_name: str) -> pd.Series:
+    """Return the mapping of all chromosome aliases to the chromosome names of a
+    local NCBI or UCSC genome.
+
+    Parameters
+    ----------
+    genome_name : str
+        Name of local genome.
 
+    Returns
+    -------
+    pandas.Series
+        Categorical chromosome names, indexed by alias.
+    """
+    logger.info("Loading chromosome mapping.")
+    genome = load_genome(genome_name)
     if genome.provider not in ["UCSC", "NCBI"]:
         logger.error(f"Can't map to provider {genome.provider}")
         return None
 
-    asm_report = ncbi_assembly_report(asm_acc)
-    asm_report.loc[
-        asm_report["Sequence-Role"] != "assembled-molecule", "Assigned-Molecule"
-    ] = "na"
+    logger.info(f"Mapping to {genome.provider} sequence names")
+    return chrom_alias_table(genome.assembly_accession)[genome.provider]
+
+
+def translate_chroms(chroms: pd.Series, mapping: pd.Series) -> pd.Series:
+    """Translate chromosome names with a mapping from load_mapping().
+
+    Only the distinct names are looked up, the translation of the column is a
+    remap of the categorical codes.
+
+    Parameters
+    ----------
+    chroms : pandas.Series
+        Chromosome names.
+    mapping : pandas.Series
+        Categorical chromosome names, indexed by alias.
+
+    Returns
+    -------
+    pandas.Series
+        Categorical translated chromosome names, missing if there is no alias.
+    """
+    categorical = pd.Categorical(chroms)
+    rows = mapping.index.get_indexer(categorical.categories.astype(str))
+    new_codes = np.where(rows >= 0, mapping.cat.codes.to_numpy()[rows], -1)
+    # the extra -1 at the end keeps missing values (code -1) missing
+    codes = np.append(new_codes, -1)[categorical.codes]
+    translated = pd.Categorical.from_codes(codes, dtype=mapping.dtype)
+    return pd.Series(translated, index=chroms.index)
+
+
+def _annotation_files(genome: str) -> Tuple[str, str]:
+    """Return the BED and GTF annotation of a local genome (None if missing)."""
+    try:
+        g = load_genome(genome)
+    except FileNotFoundError:
+        return None, None
+    genome_dir = os.path.dirname(g.filename)
+    files = []
+    for ext in ["bed", "gtf"]:
+        fname = os.path.join(genome_dir, f"{genome}.annotation.{ext}.gz")
+        files.append(fname if os.path.exists(fname) else None)
+    return tuple(files)
+
+
+def _read_annotation(bed: str, gtf: str) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Read the gene locations and the names they can be found by.
+
+    Parameters
+    ----------
+    bed : str
+        BED annotation, the names in the 4th column are used.
+    gtf : str
+        GTF annotation, genes can be found by gene name and gene ID (with and
+        without version).
 
-    mapping = asm_report[["Sequence-Name", "UCSC-style-name", "Assigned-Molecule", "GenBank-Accn"]]                                                                
+    Returns
+    -------
+    (pandas.DataFrame, pandas.DataFrame)
+        Locations (chrom, start, end, strand) and keys (key, row) where row is
+        the location of the key.
+    """
+    locations, keys = [], []
+    if bed is not None:
+        df = pd.read_table(
+            bed,
+            usecols=[0, 1, 2, 3, 5],
+            names=["chrom", "start", "end", "name", "strand"],
+            dtype={"chrom": str, "name": str},
+        )
+        locations.append(df[["chrom", "start", "end", "strand"]])
+        keys.append(df["name"])
+
+    if gtf is not None:
+        df = pd.read_table(
+            gtf,
+            comment="#",
+            usecols=[0, 2, 3, 4, 6, 8],
+            names=["chrom", "feature", "start", "end", "strand", "attributes"],
+            dtype={"chrom": str},
+        )
+        attrs = df["attributes"]
+        df["gene_id"] = attrs.str.extract(r'gene_id "([^"]+)"', expand=False)
+        df["gene_name"] = attrs.str.extract(r'gene_name "([^"]+)"', expand=False)
+        if (df["feature"] == "gene").any():
+            df = df[df["feature"] == "gene"]
+        else:
+            # the gene spans all its transcripts
+            df = df.groupby("gene_id", as_index=False).agg(
+                chrom=("chrom", "first"),
+                start=("start", "min"),
+                end=("end", "max"),
+                strand=("strand", "first"),
+                gene_name=("gene_name", "first"),
+            )
+        df = df.assign(start=df["start"] - 1).reset_index(drop=True)
+
+        offset = sum(len(loc) for loc in locations)
+        locations.append(df[["chrom", "start", "end", "strand"]])
+        gene_id = df["gene_id"].str.replace(r"\.\d+$", "", regex=True)
+        for names in [df["gene_name"], df["gene_id"], gene_id]:
+            keys.append(names.set_axis(names.index + offset))
+
+    locations = pd.concat(locations, ignore_index=True)
+    keys = pd.concat(keys).dropna().str.upper()
+    keys = pd.DataFrame({"key": keys.values, "row": keys.index}).drop_duplicates()
+    return locations, keys.sort_values("key", kind="stable")
+
+
+def gene_index(genome: str) -> Tuple[np.ndarray, np.ndarray]:
+    """Return the gene index of the local annotation of a genome.
+
+    The index is built once from the BED and GTF annotation and stored as
+    memory-mapped numpy files. It is rebuilt when the annotation changes.
+
+    Parameters
+    ----------
+    genome : str
+        Genome name
 
-    if genome.provider == "NCBI":
-        logger.info("Mapping to NCBI sequence names")
-        id_column = "Sequence-Name"
-    elif genome.provider == "UCSC":
-        logger.info("Mapping to UCSC sequence names")
-        id_column = "UCSC-style-name"
-    mapping = pd.melt(mapping, id_vars=[id_column])
-    mapping = mapping[mapping["value"] != "na"]                                                                                                                
-    mapping = mapping.drop_duplicates().set_index("value")[[id_column]]
-    mapping.columns = ["chrom"]
-    return mapping
+    Returns
+    -------
+    (numpy.ndarray, numpy.ndarray)
+        Gene locations (chrom, start, end, strand), and the upper case gene
+        names, IDs and aliases (key) sorted, with the row of their location.
+        Returns (None, None) if the genome has no annotation.
+    """
+    files = [f for f in _annotation_files(genome) if f is not None]
+    if len(files) == 0:
+        return None, None
+
+    # the index files are named after the annotation files they were built from
+    stamp = hashlib.md5()
+    for fname in files:
+        st = os.stat(fname)
+        stamp.update(f"{fname}:{st.st_mtime_ns}:{st.st_size}".encode())
+    prefix = os.path.join(INDEX_DIR, f"{genome}.{stamp.hexdigest()}")
+    fnames = [f"{prefix}.locations.npy", f"{prefix}.keys.npy"]
+
+    if not all(os.path.exists(fname) for fname in fnames):
+        logger.info(f"Building gene index of {genome}")
+        os.makedirs(INDEX_DIR, exist_ok=True)
+        locations, keys = _read_annotation(*_annotation_files(genome))
+        chrom_dtype = f"U{max(locations['chrom'].str.len(), default=1)}"
+        key_dtype = f"U{max(keys['key'].str.len(), default=1)}"
+        arrays = [
+            locations.to_records(
+                index=False, column_dtypes={"chrom": chrom_dtype, "strand": "U1"}
+            ),
+            keys.to_records(
+                index=False, column_dtypes={"key": key_dtype, "row": np.int32}
+            ),
+        ]
+        # write and rename, so concurrent jobs never read a partial index
+        for fname, arr in zip(fnames, arrays):
+            tmp = f"{fname}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                np.save(f, np.asarray(arr))
+            os.replace(tmp, fname)
+
+        # remove indexes of previous versions of the annotation
+        for fname in glob.glob(os.path.join(INDEX_DIR, f"{genome}.{'?' * 32}.*.npy")):
+            if not fname.startswith(prefix):
+                os.remove(fname)
+
+    return tuple(np.load(fname, mmap_mode="r") for fname in fnames)
 
 
 def _local_gene_annotation(genes: Iterable[str], genome: str) -> pd.DataFrame:
     """Retrieve gene location from local annotation.
 
+    Genes are found by name, gene ID or alias, case-insensitive.
+
     Parameters
     ----------
     genes : Iterable
@@ -156,25 +467,184 @@ def _local_gene_annotation(genes: Iterable[str], genome: str) -> pd.DataFrame:
     -------
     pandas.DataFrame with gene annotation.
     """
-    g = Genome(genome)
     gene_list = list(genes)
-    bed = os.path.join(os.path.dirname(g.filename), f"{genome}.annotation.bed.gz")
-    gene_info = pd.DataFrame()
-    if os.path.exists(bed):
-        df = pd.read_table(
-            bed,
-            index_col=3,
-            usecols=[0, 1, 2, 3, 5],
-            names=["chrom", "start", "end", "name", "strand"],
-        )
-        gene_info = df.loc[gene_list]
+    locations, keys = gene_index(genome)
+    if locations is None:
+        return None
+
+    key_dtype = keys.dtype["key"]
+    query = np.array([gene.upper() for gene in gene_list], dtype=key_dtype)
+    left = np.searchsorted(keys["key"], query, side="left")
+    right = np.searchsorted(keys["key"], query, side="right")
+    # names longer than the longest key would be cut off by the conversion
+    too_long = np.array([len(gene) for gene in gene_list]) > key_dtype.itemsize // 4
+    right[too_long] = left[too_long]
+
+    # all locations of each gene, in the order of the genes
+    counts = right - left
+    first = np.cumsum(counts) - counts
+    matches = np.repeat(left - first, counts) + np.arange(counts.sum())
+    rows = keys["row"][matches]
+    gene_info = pd.DataFrame(locations[rows])
+    gene_info.insert(3, "name", np.repeat(np.array(gene_list, dtype=object), counts))
+    gene_info = gene_info.drop_duplicates()
 
     # If we find more than half of the genes we assume this worked.
-    if gene_info.shape[0] >= 0.5 * len(gene_list):
-        return gene_info.reset_index()[["chrom", "start", "end", "name", "strand"]]
+    if (counts > 0).sum() >= 0.5 * len(gene_list):
+        gene_info = gene_info.reset_index(drop=True)
+        return gene_info[["chrom", "start", "end", "name", "strand"]]
+
+
+class MyGeneBackend:
+    """Query mygene.info, or a local server with the same API.
+
+    Parameters
+    ----------
+    url : str, optional
+        URL of the server, by default mygene.info.
+    """
+
+    def __init__(self, url: str = None):
+        self.url = url
+
+    def __call__(self, genes: List[str], species: str) -> List[dict]:
+        mg = mygene.MyGeneInfo()
+        if self.url is not None:
+            mg.url = self.url.rstrip("/")
+        return mg.querymany(
+            genes,
+            scopes="symbol,name,ensemblgene,entrezgene",
+            fields="genomic_pos",
+            species=species,
+            verbose=False,
+        )
+
+
+class FixtureBackend:
+    """Answer mygene.info queries from a JSON file, for tests and offline nodes.
+
+    Parameters
+    ----------
+    fname : str
+        JSON file with a list of hits as returned by mygene.info querymany, every
+        hit has the "query" it matches.
+    """
+
+    def __init__(self, fname: str):
+        with open(fname) as f:
+            hits = json.load(f)
+        self.hits = {}
+        for hit in hits:
+            self.hits.setdefault(hit["query"], []).append(hit)
+
+    def __call__(self, genes: List[str], species: str) -> List[dict]:
+        result = []
+        for gene in genes:
+            result.extend(self.hits.get(gene, [{"query": gene, "notfound": True}]))
+        return result
+
+
+def default_backend():
+    """Return the backend for mygene.info queries.
+
+    The fixture file in $MYGENE_FIXTURE if it is set, otherwise the server at
+    $MYGENE_URL, or mygene.info itself.
+    """
+    if os.environ.get("MYGENE_FIXTURE"):
+        return FixtureBackend(os.environ["MYGENE_FIXTURE"])
+    return MyGeneBackend(os.environ.get("MYGENE_URL"))
+
+
+def _query_chunk(backend, genes: List[str], species: str) -> List[dict]:
+    """Query a chunk of genes, retrying with exponential backoff."""
+    for attempt in range(MYGENE_RETRIES + 1):
+        try:
+            return backend(genes, species)
+        except OSError as e:
+            if attempt == MYGENE_RETRIES:
+                raise
+            wait = MYGENE_BACKOFF * 2 ** attempt
+            logger.warning(f"mygene.info query failed ({e}), retrying in {wait}s")
+            time.sleep(wait)
 
 
-def gene_annotation(genes: Iterable[str], genome: str) -> pd.DataFrame:
+def query_mygene(genes: Iterable[str], species: str, backend=None) -> pd.DataFrame:
+    """Query the genomic position of genes in mygene.info.
+
+    The genes are queried in chunks of MYGENE_CHUNKSIZE, MYGENE_THREADS at a
+    time. The results of the chunks that succeed are merged, the genes in chunks
+    that keep failing are logged and left out. If no chunk succeeds, the last
+    error is raised.
+
+    Parameters
+    ----------
+    genes : Iterable
+        List of gene names or gene identifiers such as ensembl_id.
+    species : str
+        Taxonomy ID or species name.
+    backend : callable, optional
+        Function that takes a list of genes and a species, and returns the
+        mygene.info hits. By default default_backend().
+
+    Returns
+    -------
+    pandas.DataFrame
+        One row per genomic position of each hit, indexed by query.
+
+    Raises
+    ------
+    OSError
+        If mygene.info could not be queried at all.
+    ValueError
+        If none of the genes is found.
+    """
+    if backend is None:
+        backend = default_backend()
+    gene_list = list(genes)
+    chunks = [
+        gene_list[i : i + MYGENE_CHUNKSIZE]
+        for i in range(0, len(gene_list), MYGENE_CHUNKSIZE)
+    ]
+
+    hits = []
+    error, failed = None, 0
+    with ThreadPoolExecutor(MYGENE_THREADS) as executor:
+        futures = [
+            executor.submit(_query_chunk, backend, chunk, species) for chunk in chunks
+        ]
+        for chunk, future in zip(chunks, futures):
+            try:
+                hits.extend(future.result())
+            except OSError as e:
+                logger.error(f"Could not query {len(chunk)} genes in mygene.info: {e}")
+                error = e
+                failed += 1
+
+    # an outage is not the same as genes that are not found
+    if len(chunks) > 0 and failed == len(chunks):
+        raise error
+
+    # a gene can be found on more than one position, use a row for each
+    records = []
+    for hit in hits:
+        if hit.get("notfound") or "genomic_pos" not in hit:
+            continue
+        positions = hit["genomic_pos"]
+        if isinstance(positions, dict):
+            positions = [positions]
+        for pos in positions:
+            records.append({"query": hit["query"], "_score": hit.get("_score", 0), **pos})
+
+    if len(records) == 0:
+        raise ValueError(f"No matching genes found in mygene.info for {species}")
+
+    result = pd.DataFrame(records).set_index("query")
+    return result.add_prefix("genomic_pos.").rename(
+        columns={"genomic_pos._score": "_score"}
+    )
+
+
+def gene_annotation(genes: Iterable[str], genome: str, backend=None) -> pd.DataFrame:
     """Retrieve genomic annotation of a set of genes.
 
     If the annotation is not present locally, then mygene.info is used.
@@ -187,12 +657,21 @@ def gene_annotation(genes: Iterable[str], genome: str) -> pd.DataFrame:
         List of gene names or gene identifiers such as ensembl_id.
     genome : str
         Genome name
+    backend : callable, optional
+        Backend for the mygene.info queries, see query_mygene().
 
     Returns
     -------
     pandas.DataFrame with gene annotation.
+
+    Raises
+    ------
+    ValueError
+        If none of the genes is found.
     """
 
+    genes = list(genes)
+
     # First try to find the genes in the local annotation installed by genomepy.
     gene_info = _local_gene_annotation(genes, genome)
     if gene_info is not None:
@@ -211,29 +690,24 @@ def gene_annotation(genes: Iterable[str], genome: str) -> pd.DataFrame:
         return None
 
     # Run the actual query
-    g = Genome(genome)
+    g = load_genome(genome)
     logger.info("Querying mygene.info...")
-    mg = mygene.MyGeneInfo()
-    result = mg.querymany(
-        genes,
-        scopes="symbol,name,ensemblgene,entrezgene",
-        fields="genomic_pos",
-        species=g.tax_id,
-        as_dataframe=True,
-        verbose=False
-    )
+    result = query_mygene(genes, g.tax_id, backend)
+    return _mygene_annotation(result, genome)
 
-    if "notfound" in result and result.shape[1] == 1:
-        logger.error("No matching genes found")
-        sys.exit()
 
+def _mygene_annotation(result: pd.DataFrame, genome: str) -> pd.DataFrame:
+    """Convert the mygene.info hits from query_mygene() to the gene annotation of
+    a genome, with the chromosome names of the genome.
+    """
+    g = load_genome(genome)
     if g.provider == "Ensembl":
         result = result.rename(columns={"genomic_pos.chr": "chrom"})
     else:
         # Ensembl, UCSC and NCBI chromosome names can all be different :-/
         logger.info("Local genome is not an Ensembl genome.")
         mapping = load_mapping(g.name)
-        result = result.join(mapping, on="genomic_pos.chr")
+        result["chrom"] = translate_chroms(result["genomic_pos.chr"], mapping)
         result = result.dropna(subset=["chrom"])
 
     # Convert genomic positions from string to integer
@@ -253,11 +727,75 @@ def gene_annotation(genes: Iterable[str], genome: str) -> pd.DataFrame:
     result = result.reset_index()[
         ["chrom", "genomic_pos.start", "genomic_pos.end", "query", "strand"]
     ]
-    result.columns = [["chrom", "start", "end", "name", "strand"]]
+    result.columns = ["chrom", "start", "end", "name", "strand"]
 
     return result
 
 
+def gene_annotations(
+    genes: Mapping[str, Iterable[str]], backend=None, threads: int = 4
+) -> pd.DataFrame:
+    """Retrieve genomic annotation of sets of genes in many genomes.
+
+    Works like gene_annotation(), but every genome is loaded once, the local
+    annotations are searched in parallel, and genes that are not found locally
+    are queried in mygene.info with one batched query per species.
+
+    Parameters
+    ----------
+    genes : Mapping
+        Genome names with the gene names or gene identifiers to look up.
+    backend : callable, optional
+        Backend for the mygene.info queries, see query_mygene().
+    threads : int, optional
+        Number of genomes to search locally at the same time.
+
+    Returns
+    -------
+    pandas.DataFrame with gene annotation and the genome of each gene. Genomes
+    without any matching genes are left out.
+    """
+    genes = {genome: list(gene_list) for genome, gene_list in genes.items()}
+
+    # First try to find the genes in the local annotations installed by genomepy.
+    with ThreadPoolExecutor(threads) as executor:
+        local = executor.map(_local_gene_annotation, genes.values(), genes.keys())
+        gene_info = dict(zip(genes, local))
+
+    # Genes that are not found locally are queried per species, and only for
+    # genomes that match the Ensembl genome (see gene_annotation()).
+    species = {}
+    for genome, result in gene_info.items():
+        if result is not None:
+            continue
+        logger.info(f"No local matching genes found for {genome}, trying mygene.info")
+        if ensembl_genome_info(genome) is not None:
+            species.setdefault(load_genome(genome).tax_id, []).append(genome)
+
+    for tax_id, genomes in species.items():
+        query = list(dict.fromkeys(chain.from_iterable(genes[g] for g in genomes)))
+        logger.info(f"Querying mygene.info for {len(genomes)} genomes of {tax_id}...")
+        try:
+            result = query_mygene(query, tax_id, backend)
+        except ValueError as e:
+            logger.error(e)
+            continue
+        for genome in genomes:
+            hits = result[result.index.isin(genes[genome])]
+            if len(hits) > 0:
+                gene_info[genome] = _mygene_annotation(hits.copy(), genome)
+
+    frames = [
+        result.assign(genome=genome)
+        for genome, result in gene_info.items()
+        if result is not None
+    ]
+    columns = ["genome", "chrom", "start", "end", "name", "strand"]
+    if len(frames) == 0:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(frames, ignore_index=True)[columns]
+
+
 if __name__ == "__main__":
     for genome in ["hg38", "Xenopus_tropicalis_v9.1"]:
         print(genome)
@@ -1,21 +1,904 @@
 """
 From narrowpeaks -> fasta.
 """
+import contextlib
+import functools
+import hashlib
+import json
 import multiprocessing
+import os
+import threading
+import time
+from collections import Counter
+from typing import Callable, Iterator, List, Optional, Tuple
 
+import numpy as np
 import pybedtools
 import pyfaidx
 
 
 LINEWIDTH = 80
 PEAKWIDTH = 100
+MAXPEAKLENGTH = 2000
+CHUNKSIZE = 10_000
+GCBINS = 20
+OVERSAMPLE = 10
+INDEXDIR = "/vol/peaks/index"
+SHMDIR = "/dev/shm"
+SHMGENOMES = 2  # the number of genomes main keeps in shared memory at the same time
+RSSINTERVAL = 0.1  # seconds between the memory measurements of a task
 
+# the columns of a narrowpeak file we care about: chrom, start, end, name and summit offset
+NARROWPEAK_COLUMNS = (0, 1, 2, 3, 9)
+NARROWPEAK_DTYPE = [("chrom", "U64"), ("start", np.int64), ("end", np.int64),
+                    ("name", "U64"), ("peak", np.int64)]
 
-def get_open(assembly: str, stage: str) -> str:
+# 1 for the (ascii) G and C bases, 0 for everything else
+GC_TABLE = np.zeros(256, dtype=np.uint8)
+GC_TABLE[list(b"GCgc")] = 1
+
+# A, C, G and T (upper and lower case) to 0-3, everything else is N (4)
+ENCODE_TABLE = np.full(256, 4, dtype=np.uint8)
+ENCODE_TABLE[list(b"ACGT")] = ENCODE_TABLE[list(b"acgt")] = np.arange(4)
+META_DTYPE = [("assembly", "S32"), ("stage", "S32"), ("chrom", "S64"), ("name", "S64"),
+              ("label", np.int8)]
+
+
+def read_narrowpeak(path: str) -> np.ndarray:
+    """
+    Load the chrom, start, end, name and summit offset columns of a narrowpeak file into a numpy
+    structured array.
+
+    :return: structured array with fields chrom, start, end, name and peak
+    """
+    return np.loadtxt(path, dtype=NARROWPEAK_DTYPE, usecols=NARROWPEAK_COLUMNS,
+                      delimiter="\t", comments="#", ndmin=1)
+
+
+def read_sizes(assembly: str) -> Tuple[List[str], np.ndarray]:
+    """
+    Load the chromosome names and their lengths of an assembly, in the order of the sizes file.
+
+    :return: (chromosome names, chromosome lengths)
+    """
+    chroms, sizes = [], []
+    with open(f"/vol/genomes/{assembly}/{assembly}.fa.sizes") as sizes_file:
+        for line in sizes_file:
+            if line.strip():
+                chrom, size = line.split()[:2]
+                chroms.append(chrom)
+                sizes.append(int(size))
+    return chroms, np.array(sizes, dtype=np.int64)
+
+
+def chrom_codes(names: np.ndarray, chroms: List[str]) -> np.ndarray:
+    """
+    Translate chromosome names to their position in chroms. All names should be in chroms.
+
+    :return: array with the code of each name
+    """
+    chroms = np.array(chroms)
+    sorter = np.argsort(chroms)
+    return sorter[np.searchsorted(chroms, names, sorter=sorter)].astype(np.int64)
+
+
+def merge_intervals(start: np.ndarray, end: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Merge overlapping and book-ended intervals, like bedtools merge but on a single coordinate
+    system.
+
+    :return: (merged starts, merged ends), sorted
+    """
+    order = np.argsort(start, kind="stable")
+    start, end = start[order], np.maximum.accumulate(end[order])
+    new = np.ones(len(start), dtype=bool)
+    new[1:] = start[1:] > end[:-1]
+    last = np.append(np.flatnonzero(new)[1:] - 1, len(start) - 1)
+    return start[new], end[last]
+
+
+def closed_regions(assembly: str, stages: List[str],
+                   width: int = PEAKWIDTH) -> Tuple[np.ndarray, int]:
+    """
+    Get the regions of an assembly that are not in a peak of any of the stages. Peaks are first
+    extended with width to the left (like bedtools slop), so that a window of width that starts in
+    a closed region can never overlap a peak.
+
+    :return: (structured array with fields chrom (code in the sizes file), start and end,
+              total number of peaks)
+    """
+    chroms, sizes = read_sizes(assembly)
+    peaks = np.concatenate([
+        read_narrowpeak(f"/vol/atac-seq/genrich/{assembly}-{stage}_peaks.narrowPeak")
+        for stage in stages])
+    nr_peaks = len(peaks)
+    peaks = peaks[np.isin(peaks["chrom"], chroms)]
+    chrom = chrom_codes(peaks["chrom"], chroms)
+
+    # put all chromosomes after each other, so we can merge the whole genome at once. Empty
+    # intervals at the chromosome boundaries make sure no closed region spans two chromosomes.
+    offsets = np.concatenate([[0], np.cumsum(sizes)])
+    start = np.concatenate([offsets[chrom] + np.maximum(peaks["start"] - width, 0), offsets])
+    end = np.concatenate([offsets[chrom] + np.minimum(peaks["end"], sizes[chrom]), offsets])
+    start, end = merge_intervals(start, end)
+
+    # the complement of the peaks are the gaps between the merged intervals
+    gap_start, gap_end = end[:-1], start[1:]
+    gap_start, gap_end = gap_start[gap_end > gap_start], gap_end[gap_end > gap_start]
+    gap_chrom = np.searchsorted(offsets, gap_start, side="right") - 1
+
+    regions = np.empty(len(gap_start), dtype=[("chrom", np.int64), ("start", np.int64),
+                                              ("end", np.int64)])
+    regions["chrom"] = gap_chrom
+    regions["start"] = gap_start - offsets[gap_chrom]
+    regions["end"] = gap_end - offsets[gap_chrom]
+    return regions, nr_peaks
+
+
+def open_windows(assembly: str, stages: List[str],
+                 width: int = PEAKWIDTH) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Get the windows of width around the summits of all peaks of the stages of an assembly, with
+    the same filters as get_open.
+
+    :return: (chromosome codes in the sizes file, window starts)
+    """
+    chroms, sizes = read_sizes(assembly)
+    peaks = np.concatenate([
+        read_narrowpeak(f"/vol/atac-seq/genrich/{assembly}-{stage}_peaks.narrowPeak")
+        for stage in stages])
+    peaks = peaks[((peaks["end"] - peaks["start"]) < MAXPEAKLENGTH)
+                  & np.isin(peaks["chrom"], chroms)]
+    chrom = chrom_codes(peaks["chrom"], chroms)
+
+    low = peaks["start"] + peaks["peak"] - width // 2
+    keep = (low >= 0) & (low + width <= sizes[chrom])
+    return chrom[keep], low[keep]
+
+
+def sample_closed(regions: np.ndarray, sizes: np.ndarray, n: int, width: int = PEAKWIDTH,
+                  rng: Optional[np.random.Generator] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Draw n windows of width uniformly from all closed regions, in a single vectorized call. Each
+    possible window start has the same chance, so larger regions get proportionally more windows.
+
+    :return: (the region of each window, the start of each window), sorted by region
+    """
+    rng = np.random.default_rng() if rng is None else rng
+
+    # the number of window starts in each region that keep the window inside the chromosome
+    last = np.minimum(regions["end"], sizes[regions["chrom"]] - width + 1)
+    counts = np.maximum(last - regions["start"], 0)
+    cumulative = np.cumsum(counts)
+    if len(cumulative) == 0 or cumulative[-1] == 0:
+        raise ValueError(f"no closed regions of at least {width} bp to sample from")
+
+    positions = np.sort(rng.integers(0, cumulative[-1], n))
+    region = np.searchsorted(cumulative, positions, side="right")
+    start = regions["start"][region] + positions - (cumulative[region] - counts[region])
+    return region, start
+
+
+def gc_prefix(sequence: np.ndarray) -> np.ndarray:
+    """
+    The number of G and C bases before each position of a chromosome, so the GC content of any
+    window is just two lookups.
+
+    :return: array of length len(sequence) + 1
+    """
+    prefix = np.zeros(len(sequence) + 1, dtype=np.uint32)
+    np.cumsum(GC_TABLE[sequence], dtype=np.uint32, out=prefix[1:])
+    return prefix
+
+
+def window_gc(prefix: np.ndarray, low: np.ndarray, width: int) -> np.ndarray:
+    """
+    The GC fraction of the windows [low, low + width) of a chromosome.
+    """
+    return (prefix[low + width] - prefix[low]) / width
+
+
+def sample_closed_gc(genome, chroms: List[str], sizes: np.ndarray, regions: np.ndarray,
+                     open_chrom: np.ndarray, open_low: np.ndarray, n: int,
+                     width: int = PEAKWIDTH, rng: Optional[np.random.Generator] = None
+                     ) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Draw n windows of width from the closed regions, such that their GC content follows the same
+    histogram (GCBINS bins) as the open windows.
+
+    OVERSAMPLE * n candidate windows are drawn with sample_closed, and their GC content (and that
+    of the open windows) is looked up in a GC prefix sum that is made once per chromosome. Each bin
+    then gets its share of the n windows from the candidates in that bin. A bin with too few
+    candidates is sampled with replacement, and a bin without any candidates borrows from the
+    nearest bin that has them. Without any open windows (e.g. all peaks are too long) there is no
+    histogram to match, and the windows are drawn uniformly with sample_closed.
+
+    :return: (the region of each window, the start of each window), sorted by region
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    if len(open_low) == 0:
+        print("no open windows to match the GC content of, sampling closed windows uniformly")
+        return sample_closed(regions, sizes, n, width, rng)
+
+    region, start = sample_closed(regions, sizes, OVERSAMPLE * n, width, rng)
+    chrom = regions["chrom"][region]
+
+    # get the gc content of open and candidate windows, one chromosome at a time
+    open_gc, closed_gc = np.empty(len(open_low)), np.empty(len(start))
+    open_groups = dict(chrom_groups(open_chrom))
+    closed_groups = dict(chrom_groups(chrom))
+    for c in set(open_groups) | set(closed_groups):
+        prefix = gc_prefix(genome[chroms[c]])
+        idxs = open_groups.get(c, [])
+        open_gc[idxs] = window_gc(prefix, open_low[idxs], width)
+        idxs = closed_groups.get(c, [])
+        closed_gc[idxs] = window_gc(prefix, start[idxs], width)
+        del prefix
+
+    open_bin = np.minimum((open_gc * GCBINS).astype(int), GCBINS - 1)
+    closed_bin = np.minimum((closed_gc * GCBINS).astype(int), GCBINS - 1)
+    histogram = np.bincount(open_bin, minlength=GCBINS)
+    targets = rng.multinomial(n, histogram / histogram.sum())
+
+    candidates = dict(chrom_groups(closed_bin))
+    filled = np.array(sorted(candidates))
+    chosen = []
+    for gc_bin, target in enumerate(targets):
+        if target == 0:
+            continue
+        nearest = filled[np.argmin(np.abs(filled - gc_bin))]
+        chosen.append(rng.choice(candidates[nearest], target,
+                                 replace=len(candidates[nearest]) < target))
+
+    chosen = np.sort(np.concatenate(chosen))
+    return region[chosen], start[chosen]
+
+
+class GenomeBuffer:
+    """
+    Read-only access to the chromosomes of an assembly as numpy arrays of (ascii) bytes, straight
+    from the memory-mapped fasta file. The faidx index tells where each chromosome starts and how
+    its lines are wrapped, so a whole chromosome is read in a single pass without any parsing.
+    """
+    def __init__(self, assembly: str):
+        self.assembly = assembly
+        self.path = f"/vol/genomes/{assembly}/{assembly}.fa"
+        if not os.path.exists(f"{self.path}.fai"):
+            pyfaidx.Faidx(self.path)
+
+        # chrom: (length, offset, line bases, line width)
+        self.index = {}
+        with open(f"{self.path}.fai") as fai:
+            for line in fai:
+                chrom, *fields = line.split("\t")[:5]
+                self.index[chrom] = tuple(int(field) for field in fields)
+        self._mmap = np.memmap(self.path, dtype=np.uint8, mode="r")
+
+    def __contains__(self, chrom: str) -> bool:
+        return chrom in self.index
+
+    def size(self, chrom: str) -> int:
+        return self.index[chrom][0]
+
+    def __getitem__(self, chrom: str) -> np.ndarray:
+        length, offset, line_bases, line_width = self.index[chrom]
+        nr_full_lines, remainder = divmod(length, line_bases)
+
+        # drop the newline(s) at the end of each full line, except the last full line, which can
+        # be the end of the file without a newline
+        sequence = np.empty(length, dtype=np.uint8)
+        nr_wrapped = max(nr_full_lines - 1, 0)
+        wrapped = self._mmap[offset:offset + nr_wrapped * line_width]
+        sequence[:nr_wrapped * line_bases] = \
+            wrapped.reshape(nr_wrapped, line_width)[:, :line_bases].ravel()
+        position = offset + nr_wrapped * line_width
+        if nr_full_lines > 0:
+            sequence[nr_wrapped * line_bases:nr_full_lines * line_bases] = \
+                self._mmap[position:position + line_bases]
+            position += line_width
+
+        # then add the last partial line
+        sequence[nr_full_lines * line_bases:] = self._mmap[position:position + remainder]
+        return sequence
+
+
+class SharedGenome:
+    """
+    The genome of an assembly loaded once into shared memory (a file in SHMDIR), so that all pool
+    workers map the same copy instead of each reading it from /vol/genomes. The driver creates it,
+    workers attach to it by assembly name (see load_genome). It has the same interface as
+    GenomeBuffer, but a chromosome is a view on the shared memory instead of a copy.
+
+    The sequences of all chromosomes are stored back to back, with a small json file next to it
+    with for each chromosome its (offset, length), and the size and mtime of the fasta it was made
+    from. A shared genome that a killed driver left behind is only used if the fasta is unchanged.
+    """
+    def __init__(self, assembly: str):
+        self.assembly = assembly
+        with open(f"{self.path(assembly)}.json") as index:
+            meta = json.load(index)
+        self.source = meta.get("source")
+        self.index = meta.get("chroms", {})
+        self._data = np.memmap(self.path(assembly), dtype=np.uint8, mode="r")
+
+    @staticmethod
+    def path(assembly: str) -> str:
+        return os.path.join(SHMDIR, f"peak_to_fasta_{assembly}")
+
+    @staticmethod
+    def source_stamp(assembly: str) -> List[int]:
+        """
+        The size and mtime (in ns) of the fasta of an assembly.
+        """
+        stat = os.stat(f"/vol/genomes/{assembly}/{assembly}.fa")
+        return [stat.st_size, stat.st_mtime_ns]
+
+    @classmethod
+    def create(cls, assembly: str) -> "SharedGenome":
+        """
+        Read the genome of an assembly (once) into shared memory.
+        """
+        source = cls.source_stamp(assembly)
+        genome = GenomeBuffer(assembly)
+        path = cls.path(assembly)
+
+        # write to temporary files first, so a worker never attaches to a half-written genome
+        index, offset = {}, 0
+        with open(f"{path}.tmp", "wb") as shared:
+            for chrom in genome.index:
+                shared.write(genome[chrom].tobytes())
+                index[chrom] = [offset, genome.size(chrom)]
+                offset += genome.size(chrom)
+        with open(f"{path}.json.tmp", "w") as index_file:
+            json.dump({"source": source, "chroms": index}, index_file)
+        os.replace(f"{path}.tmp", path)
+        os.replace(f"{path}.json.tmp", f"{path}.json")
+        return cls(assembly)
+
+    @classmethod
+    def attach(cls, assembly: str) -> "SharedGenome":
+        """
+        Attach to the shared genome of an assembly that was created by another process.
+
+        :raises FileNotFoundError: if there is no shared genome of the assembly
+        :raises ValueError: if the fasta changed since the shared genome was made
+        """
+        shared = cls(assembly)
+        if shared.source != cls.source_stamp(assembly):
+            shared.close()
+            raise ValueError(f"shared genome {cls.path(assembly)} is older than the fasta")
+        return shared
+
+    def __contains__(self, chrom: str) -> bool:
+        return chrom in self.index
+
+    def size(self, chrom: str) -> int:
+        return self.index[chrom][1]
+
+    def __getitem__(self, chrom: str) -> np.ndarray:
+        offset, length = self.index[chrom]
+        return self._data[offset:offset + length]
+
+    def close(self) -> None:
+        # the memory is only released once no process has it mapped anymore
+        self._data = None
+
+    def unlink(self) -> None:
+        """
+        Close and remove the shared genome, only the process that created it should do this.
+        """
+        self.close()
+        for path in (self.path(self.assembly), f"{self.path(self.assembly)}.json"):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+# the shared genome a worker is attached to (at most one at a time, see release_genomes)
+_shared_genomes = {}
+
+
+def load_genome(assembly: str):
+    """
+    Get the genome of an assembly: the shared memory copy if the driver made one, and otherwise a
+    memory-mapped GenomeBuffer. Workers stay attached to a shared genome until the task is done
+    (see release_genomes), so the memory of a finished assembly is released once the driver
+    unlinks it.
+
+    :return: SharedGenome or GenomeBuffer
+    """
+    if assembly in _shared_genomes:
+        return _shared_genomes[assembly]
+
+    try:
+        shared = SharedGenome.attach(assembly)
+    except FileNotFoundError:
+        return GenomeBuffer(assembly)
+    except ValueError as error:
+        print(f"{error}, reading the fasta instead")
+        return GenomeBuffer(assembly)
+
+    release_genomes()
+    _shared_genomes[assembly] = shared
+    return shared
+
+
+def release_genomes() -> None:
+    """
+    Detach from the shared genome, so an idle worker does not keep it in memory after the driver
+    unlinked it.
+    """
+    for genome in _shared_genomes.values():
+        genome.close()
+    _shared_genomes.clear()
+
+
+def get_windows(sequence: np.ndarray, low: np.ndarray, width: int) -> np.ndarray:
+    """
+    Get the windows [low, low + width) of a chromosome all at once.
+
+    :return: array of shape (len(low), width) with the sequences as ascii bytes
+    """
+    if len(low) == 0:
+        # the chromosome can be shorter than the window
+        return np.empty((0, width), dtype=sequence.dtype)
+    return np.lib.stride_tricks.sliding_window_view(sequence, width)[low]
+
+
+def wrap_windows(windows: np.ndarray) -> List[str]:
+    """
+    Split the windows into lines of at most LINEWIDTH, all at once.
+
+    :return: the wrapped sequence of each window
+    """
+    breaks = list(range(LINEWIDTH, windows.shape[1], LINEWIDTH))
+    wrapped = np.insert(windows, breaks, ord("\n"), axis=1)
+    return wrapped.view(f"S{wrapped.shape[1]}").ravel().astype("U").tolist()
+
+
+class FastaWriter:
+    """
+    Write fasta records straight to a buffered (and optionally bgzip compressed) file as they come
+    in, so memory use does not grow with the number of records. Sequences are wrapped at LINEWIDTH
+    and records are separated by a blank line, unless blank_line is False.
+
+    Example:
+    >>> with FastaWriter("/vol/peaks/mm10-4cell_open.fa.gz", bgzip=True) as fasta:
+    ...     fasta.write("lcl|chr1|peak_0", "GTTAATGGCG")
+    """
+    def __init__(self, path: str, bgzip: bool = False, blank_line: bool = True,
+                 buffering: int = 1 << 20):
+        self.path = path
+        if bgzip:
+            # biopython is only needed when compressing
+            from Bio import bgzf
+            self._handle = bgzf.BgzfWriter(path, "wb")
+        else:
+            self._handle = open(path, "wb", buffering=buffering)
+        self._separator = b"\n\n" if blank_line else b"\n"
+        self._first = True
+
+    def write_wrapped(self, header: str, sequence: str) -> None:
+        """
+        Write a single record of which the sequence is already wrapped.
+        """
+        if not self._first:
+            self._handle.write(self._separator)
+        self._handle.write(f">{header}\n{sequence}".encode())
+        self._first = False
+
+    def write(self, header: str, sequence: str) -> None:
+        """
+        Write a single record.
+        """
+        self.write_wrapped(header, '\n'.join(sequence[i:i + LINEWIDTH]
+                                             for i in range(0, len(sequence), LINEWIDTH)))
+
+    def write_windows(self, chrom: str, names: list, windows: np.ndarray) -> None:
+        """
+        Write a batch of records of a chromosome with their sequences as (ascii) windows from
+        get_windows, with NCBI local headers (lcl|chrom|name).
+        """
+        for name, sequence in zip(names, wrap_windows(windows)):
+            self.write_wrapped(f"lcl|{chrom}|{name}", sequence)
+
+    def close(self) -> None:
+        self._handle.close()
+
+    def __enter__(self) -> "FastaWriter":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def pack_2bit(codes: np.ndarray) -> np.ndarray:
+    """
+    Pack ACGT codes (0-3) four bases per byte, the first base in the highest bits. N bases should
+    be stored separately, they end up as A.
+
+    :return: array of shape (len(codes), ceil(width / 4))
+    """
+    codes = codes & 3
+    padding = -codes.shape[1] % 4
+    codes = np.pad(codes, ((0, 0), (0, padding))).reshape(len(codes), -1, 4)
+    return (codes[..., 0] << 6) | (codes[..., 1] << 4) | (codes[..., 2] << 2) | codes[..., 3]
+
+
+def unpack_2bit(packed: np.ndarray, width: int) -> np.ndarray:
+    """
+    Unpack four 2-bit bases per byte back to ACGT codes (0-3).
+
+    :return: array of shape (len(packed), width)
+    """
+    codes = (packed[..., None] >> np.array([6, 4, 2, 0], dtype=np.uint8)) & 3
+    return codes.reshape(len(packed), -1)[:, :width]
+
+
+class EncodedWriter:
+    """
+    Write windows as memory-mappable numpy arrays instead of text, so training loaders can read
+    random minibatches without parsing anything. It has the same interface as FastaWriter, but
+    needs to know the number of windows up front.
+
+    For a prefix it writes:
+      - {prefix}.seq.npy: with encoding "uint8" an array of shape (n, width) with A, C, G, T and N
+        as 0-4, with encoding "2bit" an array of shape (n, ceil(width / 4)) with four bases per
+        byte (see pack_2bit)
+      - {prefix}.n.npy: only with encoding "2bit", a bit-packed mask of shape (n, ceil(width / 8))
+        of where the Ns are
+      - {prefix}.meta.npy: a structured array with the assembly, stage, chrom, name and label
+        (1 for open and 0 for closed) of each window
+      - {prefix}.json: the encoding, width and number of windows
+
+    See EncodedPeaks to read them.
+    """
+    def __init__(self, prefix: str, n: int, width: int, assembly: str, stage: str, label: int,
+                 encoding: str = "uint8"):
+        if encoding not in ("uint8", "2bit"):
+            raise ValueError(f"unknown encoding {encoding}, use uint8 or 2bit")
+        self.prefix = prefix
+        self.encoding = encoding
+        self._n_mask = None
+        if encoding == "uint8":
+            self._seq = np.lib.format.open_memmap(f"{prefix}.seq.npy", "w+", np.uint8, (n, width))
+        else:
+            self._seq = np.lib.format.open_memmap(f"{prefix}.seq.npy", "w+", np.uint8,
+                                                  (n, -(-width // 4)))
+            self._n_mask = np.lib.format.open_memmap(f"{prefix}.n.npy", "w+", np.uint8,
+                                                     (n, -(-width // 8)))
+        self._meta = np.lib.format.open_memmap(f"{prefix}.meta.npy", "w+", META_DTYPE, (n,))
+        self._meta["assembly"] = assembly
+        self._meta["stage"] = stage
+        self._meta["label"] = label
+        with open(f"{prefix}.json", "w") as info:
+            json.dump({"encoding": encoding, "width": width, "n": n}, info)
+        self._row = 0
+
+    def write_windows(self, chrom: str, names: list, windows: np.ndarray) -> None:
+        """
+        Write a batch of windows of a chromosome.
+        """
+        rows = slice(self._row, self._row + len(windows))
+        codes = ENCODE_TABLE[windows]
+        if self.encoding == "uint8":
+            self._seq[rows] = codes
+        else:
+            self._seq[rows] = pack_2bit(codes)
+            self._n_mask[rows] = np.packbits(codes == 4, axis=1)
+        self._meta["chrom"][rows] = chrom
+        self._meta["name"][rows] = [str(name) for name in names]
+        self._row += len(windows)
+
+    def close(self) -> None:
+        for array in (self._seq, self._n_mask, self._meta):
+            if array is not None:
+                array.flush()
+        self._seq = self._n_mask = self._meta = None
+
+    def __enter__(self) -> "EncodedWriter":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+class EncodedPeaks:
+    """
+    Read the output of EncodedWriter. Everything is memory-mapped, so only the windows that are
+    asked for are read from disk.
+
+    Example:
+    >>> peaks = EncodedPeaks("/vol/peaks/mm10-4cell_open")
+    >>> batch = np.random.randint(len(peaks), size=128)
+    >>> x, y = peaks.one_hot(batch), peaks.meta["label"][batch]
+    """
+    def __init__(self, prefix: str):
+        with open(f"{prefix}.json") as info:
+            info = json.load(info)
+        self.encoding = info["encoding"]
+        self.width = info["width"]
+        self.seq = np.load(f"{prefix}.seq.npy", mmap_mode="r")
+        self.meta = np.load(f"{prefix}.meta.npy", mmap_mode="r")
+        self.n_mask = None
+        if self.encoding == "2bit":
+            self.n_mask = np.load(f"{prefix}.n.npy", mmap_mode="r")
+
+    def __len__(self) -> int:
+        return len(self.meta)
+
+    def __getitem__(self, idxs) -> np.ndarray:
+        """
+        The windows at idxs as A, C, G, T and N codes (0-4). With encoding "uint8" this is a view on
+        the memory-mapped array when idxs is a slice.
+        """
+        if self.encoding == "uint8":
+            return self.seq[idxs]
+
+        packed = self.seq[idxs]
+        codes = unpack_2bit(np.atleast_2d(packed), self.width)
+        n_mask = np.unpackbits(np.atleast_2d(self.n_mask[idxs]), axis=1, count=self.width)
+        codes[n_mask.astype(bool)] = 4
+        return codes if packed.ndim == 2 else codes[0]
+
+    def one_hot(self, idxs) -> np.ndarray:
+        """
+        The windows at idxs one-hot encoded, with all zeros for N.
+
+        :return: float32 array of shape (len(idxs), width, 4)
+        """
+        return np.eye(5, 4, dtype=np.float32)[self[idxs]]
+
+
+def open_writer(prefix: str, output_format: str, n: int, assembly: str, stage: str, label: int,
+                bgzip: bool = False, width: int = PEAKWIDTH):
+    """
+    Open a FastaWriter (output_format "fasta") or an EncodedWriter (output_format "uint8" or
+    "2bit") for n windows of width.
+
+    :return: (writer, path of the main output file)
+    """
+    if output_format == "fasta":
+        path = f"{prefix}.fa" + (".gz" if bgzip else "")
+        return FastaWriter(path, bgzip=bgzip), path
+    return EncodedWriter(prefix, n, width, assembly, stage, label, output_format), \
+        f"{prefix}.seq.npy"
+
+
+def chunks(idxs: np.ndarray, size: int = CHUNKSIZE) -> Iterator[np.ndarray]:
+    """
+    Split an array of positions into chunks of at most size.
+    """
+    for i in range(0, len(idxs), size):
+        yield idxs[i:i + size]
+
+
+def chrom_groups(chrom: np.ndarray) -> Iterator[Tuple[object, np.ndarray]]:
+    """
+    Group the positions of an array by its values, in order of first appearance. The positions
+    within a group keep their original order.
+
+    :return: iterator of (value, positions)
+    """
+    values, first, inverse = np.unique(chrom, return_index=True, return_inverse=True)
+    order = np.argsort(inverse, kind="stable")
+    bounds = np.cumsum(np.bincount(inverse, minlength=len(values)))
+    groups = np.split(order, bounds[:-1])
+    for i in np.argsort(first):
+        yield values[i], groups[i]
+
+
+class Peaks:
+    """
+    The result of a PeakIndex query: the summits of a selection of peaks, and a window width around
+    those summits. Nothing is read from the genome until the sequences are asked for.
+    """
+    def __init__(self, assembly: str, chroms: List[str], stages: List[str], chrom: np.ndarray,
+                 stage: np.ndarray, summit: np.ndarray, name: np.ndarray, width: int):
+        self.assembly = assembly
+        self.chroms = chroms
+        self.stages = stages
+        self.chrom = chrom
+        self.stage = stage
+        self.summit = summit
+        self.name = name
+        self.width = width
+
+    def __len__(self) -> int:
+        return len(self.summit)
+
+    def __repr__(self) -> str:
+        return f"<Peaks {self.assembly}: {len(self)} peaks of width {self.width}>"
+
+    @property
+    def low(self) -> np.ndarray:
+        return self.summit - self.width // 2
+
+    @property
+    def high(self) -> np.ndarray:
+        return self.low + self.width
+
+    def windows(self) -> Iterator[Tuple[str, List[str], np.ndarray]]:
+        """
+        Lazily slice the sequences of the peaks from the genome, one chunk at a time.
+
+        :return: iterator of (chromosome, peak names, windows as ascii bytes)
+        """
+        genome = load_genome(self.assembly)
+        for chrom, idxs in chrom_groups(self.chrom):
+            chrom = self.chroms[chrom]
+            sequence = genome[chrom]
+            for chunk in chunks(idxs):
+                names = [name.decode() for name in self.name[chunk]]
+                yield chrom, names, get_windows(sequence, self.low[chunk], self.width)
+
+    def sequences(self) -> Iterator[Tuple[str, str]]:
+        """
+        Lazily slice the sequence of each peak from the genome.
+
+        :return: iterator of (fasta header, sequence)
+        """
+        for chrom, names, windows in self.windows():
+            for name, window in zip(names, windows):
+                yield f"lcl|{chrom}|{name}", window.tobytes().decode()
+
+    def to_fasta(self, path: str, bgzip: bool = False) -> str:
+        """
+        Write the sequences of the peaks to a fasta file, in the same format as get_open.
+
+        :return: path to the fasta file
+        """
+        with FastaWriter(path, bgzip=bgzip) as fasta:
+            for chrom, names, windows in self.windows():
+                fasta.write_windows(chrom, names, windows)
+        return path
+
+
+class PeakIndex:
+    """
+    A persistent on-disk index of the summits of narrowpeaks.
+
+    Each assembly gets its own directory with a small json file (chromosomes, their sizes and the
+    indexed stages) and a couple of numpy arrays that are memory-mapped when queried. The arrays
+    are sorted on a key of (stage, chromosome), so each selection is a contiguous slice that is
+    found with a binary search. The window width is only applied at query time, so changing it
+    never means re-parsing the narrowpeak files.
+
+    Example:
+    >>> index = PeakIndex()
+    >>> index.add("mm10", ["4cell", "8cell"])
+    >>> peaks = index.query("mm10", stage="4cell", chrom="chr1", width=200)
+    >>> peaks.to_fasta("/vol/peaks/mm10-4cell-chr1_open.fa")
+    """
+    ARRAYS = ("key", "start", "end", "summit", "name")
+
+    def __init__(self, root: str = INDEXDIR):
+        self.root = root
+        self._loaded = {}
+
+    def _dir(self, assembly: str) -> str:
+        return os.path.join(self.root, assembly)
+
+    def meta(self, assembly: str) -> dict:
+        """
+        The chromosomes, chromosome sizes and stages that are indexed for an assembly.
+        """
+        return self._load(assembly)[0]
+
+    def _load(self, assembly: str) -> Tuple[dict, dict]:
+        if assembly not in self._loaded:
+            with open(os.path.join(self._dir(assembly), "meta.json")) as meta_file:
+                meta = json.load(meta_file)
+            arrays = {array: np.load(os.path.join(self._dir(assembly), f"{array}.npy"),
+                                     mmap_mode="r")
+                      for array in self.ARRAYS}
+            self._loaded[assembly] = meta, arrays
+        return self._loaded[assembly]
+
+    def add(self, assembly: str, stages: List[str]) -> None:
+        """
+        Parse the narrowpeak files of stages of an assembly and add them to the index. Stages that
+        were already indexed are replaced, other stages of the assembly are kept.
+
+        :raises ValueError: if the chromosomes of the assembly changed since it was indexed
+        """
+        chroms, sizes = read_sizes(assembly)
+
+        # start from what is already indexed (minus the stages we re-index)
+        old_stages, columns = [], {array: [] for array in self.ARRAYS}
+        if os.path.exists(os.path.join(self._dir(assembly), "meta.json")):
+            meta, arrays = self._load(assembly)
+            if meta["chroms"] != chroms:
+                raise ValueError(f"chromosomes of {assembly} changed, rebuild the index")
+            old_stages = meta["stages"]
+            keep = ~np.isin(arrays["key"] // len(chroms),
+                            [i for i, stage in enumerate(old_stages) if stage in stages])
+            for array in self.ARRAYS:
+                columns[array].append(np.asarray(arrays[array])[keep])
+        all_stages = old_stages + [stage for stage in stages if stage not in old_stages]
+
+        for stage in stages:
+            peaks = read_narrowpeak(f"/vol/atac-seq/genrich/{assembly}-{stage}_peaks.narrowPeak")
+            # ignore peaks on sequences that are not in the sizes file
+            peaks = peaks[np.isin(peaks["chrom"], chroms)]
+            chrom = chrom_codes(peaks["chrom"], chroms)
+            columns["key"].append(all_stages.index(stage) * len(chroms) + chrom)
+            columns["start"].append(peaks["start"])
+            columns["end"].append(peaks["end"])
+            columns["summit"].append(peaks["start"] + peaks["peak"])
+            columns["name"].append(peaks["name"].astype("S"))
+
+        columns = {array: np.concatenate(values) for array, values in columns.items()}
+        order = np.lexsort((columns["summit"], columns["key"]))
+
+        # write to temporary files first, so a concurrent reader never sees a half-written index
+        os.makedirs(self._dir(assembly), exist_ok=True)
+        self._loaded.pop(assembly, None)
+        for array in self.ARRAYS:
+            tmp = os.path.join(self._dir(assembly), f"{array}.tmp.npy")
+            np.save(tmp, columns[array][order])
+            os.replace(tmp, os.path.join(self._dir(assembly), f"{array}.npy"))
+        tmp = os.path.join(self._dir(assembly), "meta.tmp.json")
+        with open(tmp, "w") as meta_file:
+            json.dump({"chroms": chroms, "sizes": sizes.tolist(), "stages": all_stages},
+                      meta_file)
+        os.replace(tmp, os.path.join(self._dir(assembly), "meta.json"))
+
+    def query(self, assembly: str, stage: Optional[str] = None, chrom: Optional[str] = None,
+              width: int = PEAKWIDTH, max_length: Optional[int] = MAXPEAKLENGTH) -> Peaks:
+        """
+        Get all the peaks of an assembly, optionally only of a single stage and/or chromosome, with
+        a window of width around their summit. Peaks longer than max_length and windows that fall
+        outside of the chromosome are left out, just like in get_open.
+
+        :return: the selected peaks
+        """
+        meta, arrays = self._load(assembly)
+        nr_chroms, stages = len(meta["chroms"]), meta["stages"]
+        stage_codes = range(len(stages)) if stage is None else [stages.index(stage)]
+
+        # every (stage, chrom) combination is a contiguous range of keys
+        if chrom is None:
+            key_ranges = [(s * nr_chroms, (s + 1) * nr_chroms) for s in stage_codes]
+        else:
+            c = meta["chroms"].index(chrom)
+            key_ranges = [(s * nr_chroms + c, s * nr_chroms + c + 1) for s in stage_codes]
+        bounds = np.searchsorted(arrays["key"], np.array(key_ranges).ravel()).reshape(-1, 2)
+        idxs = np.concatenate([np.arange(lo, hi) for lo, hi in bounds] + [np.array([], int)])
+
+        key = arrays["key"][idxs]
+        summit = arrays["summit"][idxs]
+        codes = key % nr_chroms
+
+        keep = np.ones(len(idxs), dtype=bool)
+        if max_length is not None:
+            keep &= (arrays["end"][idxs] - arrays["start"][idxs]) < max_length
+        low = summit - width // 2
+        keep &= low >= 0
+        keep &= low + width <= np.array(meta["sizes"], dtype=np.int64)[codes]
+
+        return Peaks(assembly, meta["chroms"], stages, codes[keep],
+                     key[keep] // nr_chroms, summit[keep], arrays["name"][idxs][keep], width)
+
+
+def get_open(assembly: str, stage: str, batch: bool = True, bgzip: bool = False,
+             output_format: str = "fasta", widths: Optional[List[int]] = None):
     """
     Convert from a narrowpeak file for the peaks of an assembly and developmental stage a fasta file
     which contains a sequence of a range of PEAKWIDTH around the summit of each peak.
 
+    In batch mode the narrowpeak file is loaded into numpy arrays, summits and bounds are checked
+    all at once, and the windows are taken per chromosome from a memory-mapped genome. The records
+    are then grouped per chromosome (in order of first appearance) instead of in file order.
+
+    Records are streamed to the output file as they are made, bgzip compressed if asked for. With
+    output_format "uint8" or "2bit" (batch mode only) the windows are stored as numpy arrays
+    instead, see EncodedWriter.
+
+    With a list of widths (batch mode only) the peaks are extracted at all of those widths at once
+    instead of at PEAKWIDTH. Only the widest window is sliced from the genome, the narrower ones are
+    views on it. Each width gets its own output, e.g. mm10-4cell_open_200bp.fa, and a width that is
+    given more than once is only extracted once.
+
     Example output fasta file:
     >lcl|chr1|peak_0
     gttaatggcgcttggcaggccgatttatatggggcattcccgccacctattggacaggagtgtgaaccgcaCGTGTTATA
@@ -25,46 +908,110 @@ def get_open(assembly: str, stage: str) -> str:
     TTCTCACATGATGTTGCCACTGGAAGTCGCCATGATGGTTCCCTGTGAAGAAAGCTTATCAAGACATTACTAATAGATAG
     CCGTCGAGCGTAATATTTAG
 
-    :return: path to the fasta file
+    :return: path to the fasta file, or a list of paths (one per distinct width) if widths are given
     """
+    if batch:
+        if widths is None:
+            return _get_open_batch(assembly, stage, bgzip, output_format, [PEAKWIDTH])[0]
+        if len(widths) == 0:
+            raise ValueError("widths should contain at least one width")
+        # each width has a single output, so write it once
+        widths = list(dict.fromkeys(widths))
+        return _get_open_batch(assembly, stage, bgzip, output_format, widths)
+    if output_format != "fasta" or widths is not None:
+        raise ValueError("other output formats and multiple widths need batch mode")
+
+    output = f"/vol/peaks/{assembly}-{stage}_open.fa" + (".gz" if bgzip else "")
+
     # load the chromosome
     genome = pyfaidx.Fasta(f"/vol/genomes/{assembly}/{assembly}.fa")
 
     # load the peak file
     narrowpeaks = pybedtools.BedTool(f"/vol/atac-seq/genrich/{assembly}-{stage}_peaks.narrowPeak")
 
-    fasta_strings = []
-    for narrowpeak in narrowpeaks:
-        if narrowpeak.length < 2000:
-            # get the summit and the flanking low and high sequences
-            summit = narrowpeak.start + int(narrowpeak.fields[-1])
-            low, high = summit - PEAKWIDTH // 2, summit + PEAKWIDTH // 2
+    with FastaWriter(output, bgzip=bgzip) as fasta:
+        for narrowpeak in narrowpeaks:
+            if narrowpeak.length < MAXPEAKLENGTH:
+                # get the summit and the flanking low and high sequences
+                summit = narrowpeak.start + int(narrowpeak.fields[-1])
+                low, high = summit - PEAKWIDTH // 2, summit + PEAKWIDTH // 2
+
+                # ignore if out of bounds
+                if low < 0 or high > len(genome[narrowpeak.chrom]):
+                    continue
 
-            # ignore if out of bounds
-            if low < 0 or high > len(genome[narrowpeak.chrom]):
-                continue
+                # store the sequence as fasta (NCBI local)
+                fasta.write(f"lcl|{narrowpeak.chrom}|{narrowpeak.name}",
+                            str(genome[narrowpeak.chrom][low:high]))
+    return output
 
-            # get the sequence and split into chunks of max line width
-            sequence = str(genome[narrowpeak.chrom][low:high])
-            sequence = '\n'.join(sequence[i:i + LINEWIDTH]
-                                 for i in range(0, len(sequence), LINEWIDTH))
 
-            # store the sequence as fasta (NCBI local)
-            fasta_strings.append(f">lcl|{narrowpeak.chrom}|{narrowpeak.name}\n"
-                                 f"{sequence}")
+def _get_open_batch(assembly: str, stage: str, bgzip: bool, output_format: str,
+                    widths: List[int]) -> List[str]:
+    """
+    Vectorized version of get_open, for one or more widths.
+    """
+    genome = load_genome(assembly)
+    peaks = read_narrowpeak(f"/vol/atac-seq/genrich/{assembly}-{stage}_peaks.narrowPeak")
+    peaks = peaks[(peaks["end"] - peaks["start"]) < MAXPEAKLENGTH]
 
-    # combine all the sequences into a single fasta and save
-    fasta = '\n\n'.join(fasta_strings)
-    with open(f"/vol/peaks/{assembly}-{stage}_open.fa", "w") as output_fasta:
-        output_fasta.write(fasta)
-    return f"/vol/peaks/{assembly}-{stage}_open.fa"
+    # get the summit, and for each width whether its window is in bounds (and in the genome at all)
+    summit = peaks["start"] + peaks["peak"]
+    chroms, inverse = np.unique(peaks["chrom"], return_inverse=True)
+    sizes = np.array([genome.size(chrom) if chrom in genome else -1 for chrom in chroms],
+                     dtype=np.int64)[inverse]
+    valid = {width: (summit - width // 2 >= 0) & (summit - width // 2 + width <= sizes)
+             for width in widths}
 
+    # ignore if out of bounds for all widths
+    keep = np.logical_or.reduce(list(valid.values()))
+    peaks, summit = peaks[keep], summit[keep]
+    valid = {width: in_bounds[keep] for width, in_bounds in valid.items()}
+    widest = max(widths)
 
-def get_closed(assembly: str, stages: list) -> None:
+    prefix = f"/vol/peaks/{assembly}-{stage}_open"
+    writers = [open_writer(prefix if len(widths) == 1 and width == PEAKWIDTH
+                           else f"{prefix}_{width}bp", output_format, int(valid[width].sum()),
+                           assembly, stage, 1, bgzip, width)
+               for width in widths]
+    with contextlib.ExitStack() as stack:
+        for writer, _ in writers:
+            stack.enter_context(writer)
+
+        for chrom, idxs in chrom_groups(peaks["chrom"]):
+            sequence = genome[chrom]
+            for chunk in chunks(idxs):
+                # slice the widest windows once, the narrower windows are views on them
+                full = chunk[valid[widest][chunk]]
+                windows = get_windows(sequence, summit[full] - widest // 2, widest)
+                for width, (writer, _) in zip(widths, writers):
+                    offset = widest // 2 - width // 2
+                    writer.write_windows(chrom, peaks["name"][full].tolist(),
+                                         windows[:, offset:offset + width])
+
+                    # close to the chromosome ends a narrow window can fit where the widest can not
+                    edge = chunk[valid[width][chunk] & ~valid[widest][chunk]]
+                    if len(edge):
+                        edge_windows = get_windows(sequence, summit[edge] - width // 2, width)
+                        writer.write_windows(chrom, peaks["name"][edge].tolist(), edge_windows)
+    return [output for _, output in writers]
+
+
+def get_closed(assembly: str, stages: list, bgzip: bool = False, seed: Optional[int] = None,
+               match_gc: bool = False, output_format: str = "fasta") -> str:
     """
     Convert from a list of narrowpeak files for the peaks of an assembly across developmental stages
     a fasta file which contains a sequence of a range of PEAKWIDTH around randomly chosen areas not
-    in any of the narrowpeak files.
+    in any of the narrowpeak files. As many sequences are drawn as there are peaks, and the same
+    seed gives the same background.
+
+    Uniformly drawn closed windows have a different GC content than open windows. With match_gc the
+    closed windows are drawn such that their GC content has the same distribution as the windows
+    get_open makes for these stages (see sample_closed_gc). Since all windows are PEAKWIDTH long,
+    they are length matched as well.
+
+    With output_format "uint8" or "2bit" the windows are stored as numpy arrays instead, see
+    EncodedWriter.
 
     Example output fasta file:
     >lcl|chr10|9650
@@ -75,63 +1022,35 @@ def get_closed(assembly: str, stages: list) -> None:
     ACAAACAAAACATTAATGGAATGAGTATAATAATTGTAACATTCTTAATCGATCATAACTTCCTTTAAGAGGAAGACGAT
     ATGTTTTTGTCTTAACGTAC
 
+    where the number after the chromosome is the index of the closed region the sequence is from.
+
     :return: path to the fasta file
     """
-    # load the chromosome
-    genome = pyfaidx.Fasta(f"/vol/genomes/{assembly}/{assembly}.fa")
+    genome = load_genome(assembly)
+    chroms, sizes = read_sizes(assembly)
+
+    # sample closed windows straight from the complement of the peaks
+    regions, nr_peaks = closed_regions(assembly, stages)
+    rng = np.random.default_rng(seed)
+    if match_gc:
+        open_chrom, open_low = open_windows(assembly, stages)
+        region, start = sample_closed_gc(genome, chroms, sizes, regions, open_chrom, open_low,
+                                         nr_peaks, PEAKWIDTH, rng)
+    else:
+        region, start = sample_closed(regions, sizes, nr_peaks, PEAKWIDTH, rng)
+
+    writer, output = open_writer(f"/vol/peaks/{assembly}_closed", output_format, len(region),
+                                 assembly, "", 0, bgzip)
+    with writer:
+        for chrom, idxs in chrom_groups(regions["chrom"][region]):
+            chrom = chroms[chrom]
+            sequence = genome[chrom]
 
-    # load the peak files
-    nr_peaks = 0
-    combination = pybedtools.BedTool(())
-    for stage in stages:
-        bed = pybedtools.BedTool(f"/vol/atac-seq/genrich/{assembly}-{stage}_peaks.narrowPeak")
-        nr_peaks += len(bed)
-        combination = combination.cat(bed)
-
-    combination = combination.slop(
-        l=PEAKWIDTH,
-        r=0,
-        g=f"/vol/genomes/{assembly}/{assembly}.fa.sizes"
-    ).merge()
-
-    # store
-    closed_sizes = []
-    closed_fasta = []
-    for i, closed_region in enumerate(combination):
-        sequence = str(genome[closed_region.chrom][closed_region.start:closed_region.end])
-        sequence = '\n'.join(sequence[i:i + LINEWIDTH]
-                             for i in range(0, len(sequence), LINEWIDTH))
-
-        length = closed_region.end - closed_region.start
-        closed_sizes.append(f"{closed_region.chrom}_{i}\t{length}\t{closed_region.start}")
-        closed_fasta.append(f">{closed_region.chrom}_{i}\n"
-                            f"{sequence}")
-
-    #
-    with open(f"/vol/peaks/{assembly}_closed.fa.sizes", 'w') as sizes:
-        sizes.write('\n'.join(closed_sizes))
-    with open(f"/vol/peaks/{assembly}_closed.fa", 'w') as fasta:
-        fasta.write('\n'.join(closed_fasta))
-    genome = pyfaidx.Fasta(f"/vol/peaks/{assembly}_closed.fa")
-
-    poss = combination.random(l=PEAKWIDTH,
-                              n=nr_peaks,
-                              g=f"/vol/peaks/{assembly}_closed.fa.sizes")
-
-    fasta_strings = []
-    for pos in poss:
-        sequence = str(genome[pos.chrom][pos.start:pos.end])
-        sequence = '\n'.join(sequence[i:i + LINEWIDTH]
-                             for i in range(0, len(sequence), LINEWIDTH))
-
-        # store the sequence as fasta (NCBI local)
-        chrom = '_'.join(pos.chrom.split('_')[:-1])
-        fasta_strings.append(f">lcl|{chrom}|{pos.chrom.split('_')[-1]}\n"
-                             f"{sequence}")
-
-    fasta = '\n\n'.join(fasta_strings)
-    with open(f"/vol/peaks/{assembly}_closed.fa", "w") as output_fasta:
-        output_fasta.write(fasta)
+            # store the sequences (as NCBI local fasta)
+            for chunk in chunks(idxs):
+                writer.write_windows(chrom, region[chunk].tolist(),
+                                     get_windows(sequence, start[chunk], PEAKWIDTH))
+    return output
 
 
 data = {'danRer11': ['48h', '8somites', '80%epiboly', 'dome', 'shield'],
@@ -141,7 +1060,222 @@ data = {'danRer11': ['48h', '8somites', '80%epiboly', 'dome', 'shield'],
         'oryLat2':  ['st11', 'st13', 'st15', 'st19', 'st21', 'st24', 'st25', 'st28',
                      'st32', 'st36', 'st40']}
 
-pool = multiprocessing.Pool(25)
-pool.starmap(get_closed, (data.items()))
-pool.starmap(get_open, [(assembly, stage)
-                        for assembly, stages in data.items() for stage in stages])
+
+# the sha256 of input files by (path, size, mtime), so a genome that many tasks read is hashed once
+_file_hashes = {}
+
+
+def file_hash(path: str) -> str:
+    """
+    The sha256 of the content of a file, read only once per run unless the file changes.
+    """
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime_ns)
+    if key not in _file_hashes:
+        sha = hashlib.sha256()
+        with open(path, "rb") as input_file:
+            for chunk in iter(lambda: input_file.read(1 << 20), b""):
+                sha.update(chunk)
+        _file_hashes[key] = sha.hexdigest()
+    return _file_hashes[key]
+
+
+class Task:
+    """
+    A single job of the batch driver: a function call, the files it reads and writes, and how
+    expensive it is (the number of peaks it processes).
+    """
+    def __init__(self, assembly: str, function: Callable, args: tuple, inputs: List[str],
+                 output: str, cost: int):
+        self.assembly = assembly
+        self.function = function
+        self.args = args
+        self.inputs = inputs
+        self.output = output
+        self.cost = cost
+        self._input_hash = None
+
+    @property
+    def name(self) -> str:
+        return f"{self.function.__name__}({', '.join(str(arg) for arg in self.args)})"
+
+    def input_hash(self) -> str:
+        """
+        The sha256 of the arguments and the hashes of all input files (see file_hash). It is
+        computed once, so record stores the hash of the inputs that up_to_date checked.
+        """
+        if self._input_hash is None:
+            sha = hashlib.sha256(repr(self.args).encode())
+            for path in self.inputs:
+                sha.update(file_hash(path).encode())
+            self._input_hash = sha.hexdigest()
+        return self._input_hash
+
+    def up_to_date(self, check: str = "mtime") -> bool:
+        """
+        Whether the output exists and is newer than all inputs (check="mtime"), or whether it was
+        made from inputs with the same content hash (check="hash").
+        """
+        if not os.path.exists(self.output):
+            return False
+        if check == "mtime":
+            return all(os.path.getmtime(path) <= os.path.getmtime(self.output)
+                       for path in self.inputs)
+        if check == "hash":
+            if not os.path.exists(f"{self.output}.sha256"):
+                return False
+            with open(f"{self.output}.sha256") as sha_file:
+                return sha_file.read().strip() == self.input_hash()
+        raise ValueError(f"unknown check {check}, use mtime or hash")
+
+    def record(self, check: str = "mtime") -> None:
+        """
+        Store the hash of the inputs next to the output, so the next run can skip it.
+        """
+        if check == "hash":
+            with open(f"{self.output}.sha256", "w") as sha_file:
+                sha_file.write(self.input_hash())
+
+
+def count_peaks(path: str) -> int:
+    """
+    Count the peaks (lines) of a narrowpeak file without parsing it.
+    """
+    with open(path, "rb") as narrowpeak:
+        return sum(chunk.count(b"\n") for chunk in iter(lambda: narrowpeak.read(1 << 20), b""))
+
+
+def make_tasks(data: dict) -> List[Task]:
+    """
+    Make a get_open task for each stage and a get_closed task for each assembly, sorted from the
+    most to the least peaks, so the big tasks do not end up last.
+    """
+    tasks = []
+    for assembly, stages in data.items():
+        genome = f"/vol/genomes/{assembly}/{assembly}.fa"
+        peaks = {stage: f"/vol/atac-seq/genrich/{assembly}-{stage}_peaks.narrowPeak"
+                 for stage in stages}
+        nr_peaks = {stage: count_peaks(path) for stage, path in peaks.items()}
+
+        tasks.append(Task(assembly, get_closed, (assembly, stages), [genome, *peaks.values()],
+                          f"/vol/peaks/{assembly}_closed.fa", sum(nr_peaks.values())))
+        tasks += [Task(assembly, get_open, (assembly, stage), [genome, peaks[stage]],
+                       f"/vol/peaks/{assembly}-{stage}_open.fa", nr_peaks[stage])
+                  for stage in stages]
+    return sorted(tasks, key=lambda task: task.cost, reverse=True)
+
+
+def _rss_anon() -> int:
+    """
+    The current anonymous resident memory of this process in bytes, so without the pages of
+    (shared) genomes that are mapped from files.
+    """
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("RssAnon:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def _run_task(function: Callable, args: tuple) -> Tuple[float, int]:
+    """
+    Run a task in a pool worker, and measure its wall time and peak memory. Workers run many tasks,
+    so the memory is sampled every RSSINTERVAL seconds by a thread while the task runs, and the
+    peak is relative to the memory the worker used when the task started.
+
+    :return: (wall time in seconds, peak increase of the anonymous RSS in bytes)
+    """
+    base = _rss_anon()
+    peak, done = [base], threading.Event()
+
+    def sample() -> None:
+        while not done.wait(RSSINTERVAL):
+            peak[0] = max(peak[0], _rss_anon())
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    start = time.perf_counter()
+    try:
+        function(*args)
+    finally:
+        done.set()
+        sampler.join()
+        release_genomes()
+    return time.perf_counter() - start, max(peak[0], _rss_anon()) - base
+
+
+def main(data: dict, processes: int = 25, check: str = "mtime") -> None:
+    """
+    Make the open and closed fastas of all assemblies and their stages.
+
+    All tasks that are not up to date (see Task.up_to_date) are submitted at once, the largest
+    first. While the pool works on them, the genomes are loaded into shared memory one assembly at
+    a time, in the order of their largest task, and released once the last task of the assembly is
+    done. At most SHMGENOMES genomes are in shared memory at the same time, tasks that start before
+    the genome of their assembly is loaded read it from the fasta instead. At the end the wall time
+    and peak memory increase of each task are reported.
+    """
+    tasks = make_tasks(data)
+    todo = [task for task in tasks if not task.up_to_date(check)]
+    print(f"{len(tasks) - len(todo)} of {len(tasks)} outputs are up to date")
+
+    # tasks are sorted by cost, so the assemblies are in the order of their largest task
+    remaining = Counter(task.assembly for task in todo)
+    genomes, stats, errors = {}, {}, []
+    slots, lock = threading.Semaphore(SHMGENOMES), threading.Lock()
+
+    def release(assembly: str) -> None:
+        # only call this while holding the lock
+        genomes.pop(assembly).unlink()
+        slots.release()
+
+    # callbacks run in the pool's result thread, one at a time
+    def finished(task: Task, result) -> None:
+        if isinstance(result, BaseException):
+            errors.append((task, result))
+        else:
+            stats[task.name] = result
+            task.record(check)
+        with lock:
+            remaining[task.assembly] -= 1
+            if remaining[task.assembly] == 0 and task.assembly in genomes:
+                release(task.assembly)
+
+    try:
+        with multiprocessing.Pool(processes) as pool:
+            for task in todo:
+                pool.apply_async(_run_task, (task.function, task.args),
+                                 callback=functools.partial(finished, task),
+                                 error_callback=functools.partial(finished, task))
+            pool.close()
+
+            for assembly in remaining:
+                # wait until an earlier genome is released, skip assemblies that are done by then
+                slots.acquire()
+                with lock:
+                    if remaining[assembly] == 0:
+                        slots.release()
+                        continue
+                genome = SharedGenome.create(assembly)
+                with lock:
+                    genomes[assembly] = genome
+                    if remaining[assembly] == 0:
+                        release(assembly)
+            pool.join()
+    finally:
+        with lock:
+            for genome in genomes.values():
+                genome.unlink()
+
+    print(f"{'task':<60}{'wall time':>12}{'task RSS':>12}")
+    for name, (wall_time, rss) in sorted(stats.items(), key=lambda item: -item[1][0]):
+        print(f"{name:<60}{wall_time:>11.1f}s{rss / 2 ** 20:>10.0f}MB")
+
+    for task, error in errors:
+        print(f"{task.name} failed: {error!r}")
+    if errors:
+        raise errors[0][1]
+
+
+if __name__ == "__main__":
+    main(data)
@@ -1,38 +1,70 @@
 #!/usr/bin/env python3
 import os
 import grp
+import glob
+import mmap
+import time
+import struct
 import psutil
+import argparse
 import subprocess
 import datetime
+from array import array
 from socket import gethostname
 
 MAIL_WHITELIST_GROUPS = ["slrinzema"]
 RAM_CUTOFF = 0.01
 RAM_TOTAL_CUTOFF = 10.0
 HOST = gethostname()
-LOG_ROOT = f"/ceph/rimlsfnwi/data/moldevbio/heeringen"\
-    f"/slrinzema/sleeplogs/{HOST}"
+SLEEPLOG_ROOT = "/ceph/rimlsfnwi/data/moldevbio/heeringen/slrinzema/sleeplogs"
+LOG_ROOT = f"{SLEEPLOG_ROOT}/{HOST}"
 LOG_FILE = ""
 
-
-def main():
+# History of every host is stored in LOG_ROOT/HISTORY_DIR, see History. Every
+# sample adds a record per user: time, user, processes, sleeping processes,
+# memory, sleeping memory, memory of the largest process and total memory.
+HISTORY_DIR = "history"
+HISTORY_RECORD = struct.Struct("<IIIIQQQQ")
+
+# Process attributes read in the first sample, see Snapshot. The user, name
+# and cmdline don't change, so later samples only read SNAPSHOT_ATTRS and read
+# the others for new processes.
+SNAPSHOT_ALL_ATTRS = ["pid", "username", "name", "memory_info", "status",
+                      "create_time", "cmdline"]
+SNAPSHOT_ATTRS = ["pid", "memory_info", "status", "create_time"]
+
+# Daemon mode: sample every DAEMON_INTERVAL seconds, and report processes that
+# have been sleeping with more than SLEEP_RAM_CUTOFF % RAM for SLEEP_HOURS
+DAEMON_INTERVAL = 60
+SLEEP_RAM_CUTOFF = 1.0
+SLEEP_HOURS = 4.0
+
+# Group memberships are read again after GROUP_TTL seconds, see GroupIndex
+GROUP_TTL = 3600
+
+# Collector mode: the history of hosts that did not add a sample in the last
+# COLLECT_STALE seconds is ignored, and users get at most one email per
+# COLLECT_EMAIL_INTERVAL seconds for all hosts together.
+COLLECT_DIR = "cluster"
+COLLECT_STALE = 600
+COLLECT_EMAIL_INTERVAL = 24 * 3600
+
+
+def main(email=True):
     """ Loop over current processes and seperate them by user.
         Afterwards write log file & send emails if necessary
     """
 
     _init_log()
 
-    # Sort processes by users
-    users = {}  # keys: username, values: User object.
-    for p in psutil.process_iter():
-        u = p.username()
-        if u == "root":
-            continue
-        if u not in users:
-            users[u] = User(u)
-        users[u].add_process(p)
+    # Read all processes once, and sort them by users
+    snapshot = Snapshot.take()
+    users = snapshot.users()  # keys: username, values: User object.
+    users.pop("root", None)
+    History(LOG_ROOT).append(snapshot, users)
 
     # Write the logs and send emails
+    whitelisted = GROUPS.whitelisted(users)
     with open(LOG_FILE, "w") as log:
         # Sort users by total memory used
         sorted_users = sorted(users.values(),
@@ -41,13 +73,140 @@ def main():
 
         for user in sorted_users:
             # Send mail if needed
-            _send_email(user)
+            if email:
+                _send_email(user, whitelisted)
 
             # write into log
             log.write("="*80 + "\n")
             log.write(str(user))
 
 
+def daemon(interval=DAEMON_INTERVAL, ram_cutoff=SLEEP_RAM_CUTOFF,
+           hours=SLEEP_HOURS, email=True):
+    """ Sample the processes every interval seconds, and keep track of how long
+        each process has been sleeping. Every sample write a log file, and
+        send an email about processes that have been sleeping with more than
+        ram_cutoff % RAM for more than hours (once per process).
+    """
+    tracker = ProcessTracker()
+    notified = set()  # processes we already sent an email about
+    while True:
+        start = time.monotonic()
+        tracker.update(Snapshot.take(tracker.snapshot))
+        users = tracker.snapshot.users()
+        users.pop("root", None)
+        History(LOG_ROOT).append(tracker.snapshot, users)
+
+        _init_log()
+        whitelisted = GROUPS.whitelisted(users)
+        with open(LOG_FILE, "w") as log:
+            sorted_users = sorted(users.values(),
+                                  key=lambda x: x.total_memory,
+                                  reverse=True)
+            for user in sorted_users:
+                rows = tracker.long_sleeping(user, ram_cutoff, hours)
+                new = [row for row in rows
+                       if tracker.key(row) not in notified]
+                if email and len(new) > 0 and user.name in whitelisted:
+                    _send_sleeping_email(user, rows, tracker, hours)
+                    notified.update(tracker.key(row) for row in rows)
+
+                log.write("="*80 + "\n")
+                log.write(str(user))
+                if len(rows) > 0:
+                    log.write(tracker.sleeping_info(user, rows, hours))
+
+        # forget processes that are gone
+        notified &= set(tracker.sleeping_since)
+        time.sleep(max(interval - (time.monotonic() - start), 0))
+
+
+def collect(interval=DAEMON_INTERVAL):
+    """ Build a cluster-wide view of the memory usage per user from the
+        history that every host appends to SLEEPLOG_ROOT. Every interval write
+        it to the cluster log, and send a single email to users with sleeping
+        processes using more than RAM_TOTAL_CUTOFF % RAM on any host.
+
+        Hosts should run with email=False, so users are only emailed once.
+    """
+    collector = Collector(SLEEPLOG_ROOT)
+    emailed = {}  # keys: username, values: time of the last email
+    while True:
+        start = time.monotonic()
+        collector.update()
+        users = collector.users()
+
+        now = datetime.datetime.now()
+        log_dir = os.path.join(SLEEPLOG_ROOT, COLLECT_DIR, now.strftime("%Y-%m-%d"))
+        os.makedirs(log_dir, exist_ok=True)
+        whitelisted = GROUPS.whitelisted(users)
+        with open(os.path.join(log_dir, now.strftime("%H:%M.log")), "w") as log:
+            for user in sorted(users, key=lambda u: -collector.memory(u)):
+                info = collector.user_info(user)
+                log.write("="*80 + "\n")
+                log.write(info)
+
+                hosts = [host for host, record in sorted(users[user].items())
+                         if record[5] / record[7] * 100 >= RAM_TOTAL_CUTOFF]
+                recent = now.timestamp() - emailed.get(user, 0) < \
+                    COLLECT_EMAIL_INTERVAL
+                if len(hosts) > 0 and user in whitelisted and not recent:
+                    _send_cluster_email(user, hosts, info)
+                    emailed[user] = now.timestamp()
+
+        time.sleep(max(interval - (time.monotonic() - start), 0))
+
+
+def query(since=None, until=None, user=None, host=None, by="user"):
+    """ Aggregate the history of all hosts per user, host, day or hour.
+
+        Records are streamed from disk, only the aggregates are kept in memory.
+        Returns a dict from group to [records, mean % RAM, max % RAM,
+        max % RAM sleeping, max % RAM of a single process], where the
+        percentages are per user and sample.
+    """
+    groups = {}
+    for host_dir in sorted(glob.glob(os.path.join(SLEEPLOG_ROOT, "*", HISTORY_DIR))):
+        history = History(os.path.dirname(host_dir))
+        if host is not None and history.host != host:
+            continue
+        for record in history.records(since, until):
+            t, name, _, _, rss, rss_sleeping, rss_max, total = record
+            if user is not None and name != user:
+                continue
+            if by == "user":
+                key = name
+            elif by == "host":
+                key = history.host
+            else:
+                fmt = "%Y-%m-%d" if by == "day" else "%Y-%m-%d %H:00"
+                key = datetime.datetime.fromtimestamp(t).strftime(fmt)
+            percent = rss / total * 100
+            g = groups.setdefault(key, [0, 0.0, 0.0, 0.0, 0.0])
+            g[0] += 1
+            g[1] += percent
+            g[2] = max(g[2], percent)
+            g[3] = max(g[3], rss_sleeping / total * 100)
+            g[4] = max(g[4], rss_max / total * 100)
+
+    for g in groups.values():
+        g[1] /= g[0]
+    return groups
+
+
+def _print_query(groups, by):
+    # Print the result of query() as a table, sorted by mean memory for
+    # users and hosts, and by time for days and hours
+    print(f"{by}\trecords\tmean %\tmax %\tmax % sleeping\tmax % process")
+    if by in ["user", "host"]:
+        keys = sorted(groups, key=lambda k: groups[k][1], reverse=True)
+    else:
+        keys = sorted(groups)
+    for key in keys:
+        n, mean, top, sleeping, process = groups[key]
+        print(f"{key}\t{n}\t{mean:.2f}\t{top:.2f}\t{sleeping:.2f}\t{process:.2f}")
+
+
 def _init_log():
     # Initialize a log folder by date & a log file name
     global LOG_ROOT, LOG_FILE
@@ -65,18 +224,9 @@ def _init_log():
     LOG_FILE = os.path.join(log_dir, now.strftime("%H:%M.log"))
 
 
-def _user_whitelisted(user):
-    # Check if user is on whitelist
-    if user in MAIL_WHITELIST_GROUPS:
-        return True
-
-    groups = [g.gr_name for g in grp.getgrall() if user in g.gr_mem]
-    return any(g in groups for g in MAIL_WHITELIST_GROUPS)
-
-
-def _send_email(user):
+def _send_email(user, whitelisted):
     # Send email if user is on whitelist
-    if not _user_whitelisted(user) \
+    if user.name not in whitelisted \
             or user.total_memory_sleeping < RAM_TOTAL_CUTOFF:
         return
 
@@ -90,81 +240,230 @@ def _send_email(user):
     subprocess.Popen(command, shell=True)
 
 
+class GroupIndex:
+    """ The groups of every user, read with a single pass over the group
+        database and read again when it is older than ttl seconds.
+    """
+
+    def __init__(self, ttl=GROUP_TTL):
+        """ Init an empty index. """
+        self.ttl = ttl
+        self.built = None
+        self.groups = {}  # keys: username, values: set of group names
+
+
+    def _update(self):
+        # Read all groups if the index is too old
+        if self.built is not None and time.monotonic() - self.built < self.ttl:
+            return
+        groups = {}
+        for g in grp.getgrall():
+            for member in g.gr_mem:
+                groups.setdefault(member, set()).add(g.gr_name)
+        self.groups = groups
+        self.built = time.monotonic()
+
+
+    def groups_of(self, user):
+        """ Get the set of groups a user is a member of. """
+        self._update()
+        return self.groups.get(user, set())
+
+
+    def whitelisted(self, users):
+        """ Return the set of users that are on the whitelist: a whitelist
+            group themselves, or a member of one.
+        """
+        self._update()
+        whitelist = set(MAIL_WHITELIST_GROUPS)
+        return {user for user in users
+                if user in whitelist or self.groups.get(user, set()) & whitelist}
+
+
+# Group index, shared by all samples of the daemon
+GROUPS = GroupIndex()
+
+
+class Snapshot:
+    """ All processes at one moment, stored by column.
+
+        Row i of the table is the process with pid pid[i], user user[i], etc.
+        Memory is the resident set size in bytes.
+    """
+
+    def __init__(self, time, total_memory):
+        """ Init an empty snapshot taken at time (seconds since epoch). """
+        self.time = time
+        self.total_memory = total_memory
+        self.pid = array("q")
+        self.rss = array("q")
+        self.create_time = array("d")
+        self.user = []
+        self.name = []
+        self.status = []
+        self.cmdline = []
+
+
+    @classmethod
+    def take(cls, previous=None):
+        """ Read all processes with a single walk over /proc.
+
+            The user, name and cmdline of processes that are in the previous
+            snapshot are taken from there. Without a previous snapshot they
+            are read in the same walk.
+        """
+        snapshot = cls(datetime.datetime.now().timestamp(),
+                       psutil.virtual_memory().total)
+        if previous is None:
+            known = {}
+            attrs = SNAPSHOT_ALL_ATTRS
+        else:
+            known = previous.rows()
+            attrs = SNAPSHOT_ATTRS
+        for p in psutil.process_iter(attrs=attrs, ad_value=None):
+            info = p.info
+            # skip processes that are gone or that we can't read
+            if info["memory_info"] is None or info["create_time"] is None:
+                continue
+            row = known.get((info["pid"], info["create_time"]))
+            if row is not None:
+                user = previous.user[row]
+                name = previous.name[row]
+                cmdline = previous.cmdline[row]
+            elif previous is None:
+                if info["username"] is None or info["name"] is None:
+                    continue
+                user = info["username"]
+                name = info["name"]
+                cmdline = " ".join(info["cmdline"] or [])
+            else:
+                try:
+                    user = p.username()
+                    name = p.name()
+                except psutil.Error:
+                    continue
+                try:
+                    cmdline = " ".join(p.cmdline())
+                except psutil.AccessDenied:
+                    cmdline = ""
+                except psutil.Error:
+                    continue
+            snapshot.pid.append(info["pid"])
+            snapshot.rss.append(info["memory_info"].rss)
+            snapshot.create_time.append(info["create_time"])
+            snapshot.user.append(user)
+            snapshot.name.append(name)
+            snapshot.status.append(info["status"] or "")
+            snapshot.cmdline.append(cmdline)
+        return snapshot
+
+
+    def rows(self):
+        """ Return a dict from (pid, create time) to row. """
+        return {(pid, ctime): row for row, (pid, ctime)
+                in enumerate(zip(self.pid, self.create_time))}
+
+
+    def __len__(self):
+        return len(self.pid)
+
+
+    def memory_percent(self, row):
+        """ Memory usage of the process in a row, as percentage of total. """
+        return self.rss[row] / self.total_memory * 100
+
+
+    def users(self):
+        """ Split the processes by user, returns a dict of User objects. """
+        rows = {}
+        for row, user in enumerate(self.user):
+            rows.setdefault(user, []).append(row)
+        return {user: User(user, self, r) for user, r in rows.items()}
+
+
+def _send_sleeping_email(user, rows, tracker, hours):
+    # Send email about processes that have been sleeping for long
+    message = f"Hello {user.name},\n\n" + \
+              f"On {HOST} you have {len(rows)} processes that have been " + \
+              f"sleeping for more than {hours} hours.\n" + \
+              tracker.sleeping_info(user, rows, hours)
+    # pass the message on stdin, cmdlines can contain anything
+    subprocess.run(["mail", "-s", f"Long sleeping processes on {HOST}",
+                    user.name], input=message, text=True)
+
+
+def _send_cluster_email(user, hosts, info):
+    # Send one email about the sleeping processes of a user on all hosts
+    message = f"Hello {user},\n\n" + \
+              f"On {', '.join(hosts)} you currently have processes that " + \
+              f"are sleeping and using more than {RAM_TOTAL_CUTOFF}% of " + \
+              f"total memory.\nMore info:\n\n{info}"
+    # pass the message on stdin, cmdlines can contain anything
+    subprocess.run(["mail", "-s", f"Sleeping processes on {len(hosts)} hosts",
+                    user], input=message, text=True)
+
+
 class User:
     """ A class to hold all process data for a user. """
 
-    def __init__(self, name):
-        """ Init user with name. """
+    def __init__(self, name, snapshot, rows):
+        """ Init user with name, and its rows in the snapshot. """
         self.name = name
-        self.processes = {}
-
-
-    def add_process(self, process):
-        """ Add a process to the processes dictionary. """
-        self.processes[process.pid] = process
+        self.snapshot = snapshot
+        self.rows = rows
 
 
     @property
     def processes_total(self):
         """ Get total processes. """
-        return len(self.processes)
+        return len(self.rows)
 
 
     @property
     def processes_by_cutoff(self):
         """ Seperate processes by ram usage.
 
-            Returns two lists 'above' and 'below'.
+            Returns two lists of rows 'above' and 'below'.
         """
         above = []
         below = []
-        for pid, process in self.processes.items():
-            if psutil.pid_exists(pid) \
-                    and process.memory_percent() <= RAM_CUTOFF:
-                below.append(process)
+        for row in self.rows:
+            if self.snapshot.memory_percent(row) <= RAM_CUTOFF:
+                below.append(row)
             else:
-                above.append(process)
+                above.append(row)
         return above, below
 
 
     @property
     def processes_sleeping(self):
-        """ Gets all sleeping processes and returns them as a list. """
-        sleeping = []
-        for pid, process in self.processes.items():
-            if psutil.pid_exists(pid) and \
-                    process.status() == "sleeping":
-                sleeping.append(process)
-        return sleeping
+        """ Gets the rows of all sleeping processes and returns them as a list. """
+        return [row for row in self.rows
+                if self.snapshot.status[row] == "sleeping"]
 
 
     @property
     def total_memory(self):
         """ Get memory usage of all processes. """
-        mem = 0
-        for pid, process in self.processes.items():
-            if psutil.pid_exists(pid):
-                mem += process.memory_percent()
+        mem = sum(self.snapshot.memory_percent(row) for row in self.rows)
         return round(mem, 3)
 
 
     @property
     def total_memory_sleeping(self):
         """ Get memory usage of all sleeping processes. """
-        mem = 0
-        for pid, process in self.processes.items():
-            if psutil.pid_exists(pid) and process.status() == "sleeping":
-                mem += process.memory_percent()
+        mem = sum(self.snapshot.memory_percent(row)
+                  for row in self.processes_sleeping)
         return round(mem, 3)
 
 
-    def _process_info(self, process):
+    def _process_info(self, row):
         # Get info for the processes and turn it into a readable string
+        s = self.snapshot
         startdate = datetime.datetime.fromtimestamp(
-                process.create_time()).strftime("%Y-%m-%d %H:%M:%S")
-        repr = f"{process.pid}\t{process.name()}\t{round(process.memory_percent(),2)}%\t{startdate}\t{process.status()}\n"
-        cmdline = ' '.join(process.cmdline())
-        repr += f" └─ {cmdline}\n"
+                s.create_time[row]).strftime("%Y-%m-%d %H:%M:%S")
+        repr = f"{s.pid[row]}\t{s.name[row]}\t{round(s.memory_percent(row),2)}%\t{startdate}\t{s.status[row]}\n"
+        repr += f" └─ {s.cmdline[row]}\n"
         return repr
 
 
@@ -178,17 +477,303 @@ class User:
         if len(above) > 0:
             repr += f"\nProcesses above {RAM_CUTOFF}% RAM:\n"
             repr += "pid\tname\tmem %\tstartdate\tstate\n"
-            for process in above:
-                repr += self._process_info(process)
+            for row in above:
+                repr += self._process_info(row)
 
         if len(below) > 0:
             repr += f"\nProcesses below {RAM_CUTOFF}% RAM:\n"
             repr += "pid\tname\tmem %\tstartdate\tstate\n"
-            for process in below:
-                repr += self._process_info(process)
+            for row in below:
+                repr += self._process_info(row)
+
+        return repr + "\n"
+
+
+class History:
+    """ Append-only history of the memory usage per user on a host.
+
+        Every day is a file of fixed size records (HISTORY_RECORD) sorted by
+        time, and users are stored by their index in the users file.
+    """
+
+    def __init__(self, host_dir):
+        """ Init the history in the log folder of a host. """
+        self.path = os.path.join(host_dir, HISTORY_DIR)
+        self.host = os.path.basename(os.path.normpath(host_dir))
+        self.users_file = os.path.join(self.path, "users")
+
+
+    def user_names(self):
+        """ Return the list of user names, the index is the user in records. """
+        if not os.path.exists(self.users_file):
+            return []
+        with open(self.users_file) as f:
+            return f.read().split()
+
+
+    def append(self, snapshot, users):
+        """ Add a record for every user in a snapshot. """
+        os.makedirs(self.path, exist_ok=True)
+        names = self.user_names()
+        new = [name for name in users if name not in names]
+        if len(new) > 0:
+            with open(self.users_file, "a") as f:
+                f.write("".join(f"{name}\n" for name in new))
+            names += new
+        index = {name: i for i, name in enumerate(names)}
+
+        records = []
+        for name, user in users.items():
+            sleeping = user.processes_sleeping
+            records.append(HISTORY_RECORD.pack(
+                int(snapshot.time), index[name], user.processes_total,
+                len(sleeping), sum(snapshot.rss[row] for row in user.rows),
+                sum(snapshot.rss[row] for row in sleeping),
+                max(snapshot.rss[row] for row in user.rows),
+                snapshot.total_memory))
+
+        day = datetime.datetime.fromtimestamp(snapshot.time).strftime("%Y-%m-%d")
+        with open(os.path.join(self.path, f"{day}.bin"), "ab") as f:
+            f.write(b"".join(records))
+
+
+    def new_records(self, position):
+        """ Read the records that were appended after position (day file,
+            offset). Without a position only the latest day is read.
+
+            Returns the records, and the new position.
+        """
+        fnames = sorted(glob.glob(os.path.join(self.path, "*.bin")))
+        if position is None and len(fnames) > 0:
+            position = (fnames[-1], 0)
+
+        data = []
+        size = HISTORY_RECORD.size
+        for fname in fnames:
+            if fname < position[0]:
+                continue
+            offset = position[1] if fname == position[0] else 0
+            with open(fname, "rb") as f:
+                f.seek(offset)
+                chunk = f.read()
+            # a record that is still being written is read next time
+            chunk = chunk[:len(chunk) // size * size]
+            data.append(chunk)
+            position = (fname, offset + len(chunk))
+
+        # users are added to the users file before their records are written
+        names = self.user_names()
+        records = [(t, names[user], *rest) for t, user, *rest
+                   in HISTORY_RECORD.iter_unpack(b"".join(data))]
+        return records, position
+
+
+    def records(self, since=None, until=None):
+        """ Yield the records with since <= time < until (datetimes), with the
+            user name instead of the index.
+        """
+        start = int(since.timestamp()) if since is not None else 0
+        end = int(until.timestamp()) if until is not None else 2 ** 32
+        first_day = datetime.datetime.fromtimestamp(start).strftime("%Y-%m-%d")
+        last_day = datetime.datetime.fromtimestamp(end - 1).strftime("%Y-%m-%d") \
+            if until is not None else "9999-99-99"
+
+        for fname in sorted(glob.glob(os.path.join(self.path, "*.bin"))):
+            day = os.path.basename(fname)[:-4]
+            if day < first_day or day > last_day or os.path.getsize(fname) == 0:
+                continue
+            with open(fname, "rb") as f, \
+                    mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                # users are added to the users file before their records are
+                # written, so read it after mapping to know all users in mm
+                names = self.user_names()
+                # a record that is still being written is left out
+                n = len(mm) // HISTORY_RECORD.size
+                lo = self._bisect(mm, n, start)
+                hi = self._bisect(mm, n, end)
+                size = HISTORY_RECORD.size
+                for i in range(lo, hi, 10_000):
+                    chunk = mm[i * size:min(i + 10_000, hi) * size]
+                    for t, user, *rest in HISTORY_RECORD.iter_unpack(chunk):
+                        yield (t, names[user], *rest)
+
+
+    @staticmethod
+    def _bisect(mm, n, t):
+        # Index of the first record at or after time t
+        lo, hi = 0, n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if HISTORY_RECORD.unpack_from(mm, mid * HISTORY_RECORD.size)[0] < t:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+
+class Collector:
+    """ Follows the history of all hosts, and keeps the latest record of every
+        user on every host.
+    """
+
+    def __init__(self, root):
+        """ Init the collector of the hosts in a sleeplogs folder. """
+        self.root = root
+        self.positions = {}  # keys: host, values: position in its history
+        self.latest = {}  # keys: (host, user), values: latest record
+
+
+    def update(self):
+        """ Read the records that hosts added since the last update. """
+        for host_dir in glob.glob(os.path.join(self.root, "*", HISTORY_DIR)):
+            history = History(os.path.dirname(host_dir))
+            records, self.positions[history.host] = \
+                history.new_records(self.positions.get(history.host))
+            for record in records:
+                self.latest[(history.host, record[1])] = record
+
+        # the last sample of every host, drop users that are not in it anymore
+        last = {}
+        for (host, _), record in self.latest.items():
+            last[host] = max(last.get(host, 0), record[0])
+        now = datetime.datetime.now().timestamp()
+        self.latest = {(host, user): record
+                       for (host, user), record in self.latest.items()
+                       if record[0] == last[host]
+                       and now - record[0] < COLLECT_STALE}
+
+
+    def users(self):
+        """ Return a dict from user to a dict from host to its latest record. """
+        users = {}
+        for (host, user), record in self.latest.items():
+            users.setdefault(user, {})[host] = record
+        return users
+
+
+    def memory(self, user):
+        """ Memory of a user on all hosts together, in GB. """
+        return sum(record[4] for (host, u), record in self.latest.items()
+                   if u == user) / 1e9
+
+
+    def user_info(self, user):
+        """ Printable info about the memory usage of a user on every host. """
+        repr = f"{user}\n{round(self.memory(user), 1)} GB RAM on all hosts\n\n"
+        repr += "host\tprocesses\tsleeping\tmem %\tsleeping mem %\n"
+        for (host, u), record in sorted(self.latest.items()):
+            if u != user:
+                continue
+            _, _, processes, sleeping, rss, rss_sleeping, _, total = record
+            repr += f"{host}\t{processes}\t{sleeping}\t" + \
+                f"{round(rss / total * 100, 2)}%\t" + \
+                f"{round(rss_sleeping / total * 100, 2)}%\n"
+        return repr + "\n"
+
+
+class ProcessTracker:
+    """ Keeps track of processes over the snapshots of the daemon.
+
+        A process is identified by its pid and create time, so a reused pid is
+        a new process. A process counts as sleeping since the first snapshot
+        in a row in which it was sleeping.
+    """
+
+    def __init__(self):
+        """ Init without snapshots. """
+        self.snapshot = None
+        self.sleeping_since = {}  # keys: (pid, create time), values: time
 
+
+    def key(self, row):
+        """ The (pid, create time) of the process in a row of the snapshot. """
+        return self.snapshot.pid[row], self.snapshot.create_time[row]
+
+
+    def update(self, snapshot):
+        """ Add a new snapshot, and update the sleeping time of the processes. """
+        self.snapshot = snapshot
+        sleeping_since = {}
+        for row, status in enumerate(snapshot.status):
+            if status == "sleeping":
+                key = self.key(row)
+                sleeping_since[key] = self.sleeping_since.get(key, snapshot.time)
+        self.sleeping_since = sleeping_since
+
+
+    def sleeping_hours(self, row):
+        """ Hours the process in a row has been sleeping. """
+        since = self.sleeping_since.get(self.key(row), self.snapshot.time)
+        return (self.snapshot.time - since) / 3600
+
+
+    def long_sleeping(self, user, ram_cutoff, hours):
+        """ Rows of the processes of a user that have been sleeping with more
+            than ram_cutoff % RAM for more than hours.
+        """
+        return [row for row in user.processes_sleeping
+                if self.snapshot.memory_percent(row) > ram_cutoff
+                and self.sleeping_hours(row) > hours]
+
+
+    def sleeping_info(self, user, rows, hours):
+        """ Printable info about the long sleeping processes of a user. """
+        repr = f"\nProcesses sleeping for more than {hours} hours:\n"
+        repr += "pid\tname\tmem %\tstartdate\tstate\thours sleeping\n"
+        for row in rows:
+            info = user._process_info(row)
+            line, cmdline = info.split("\n", 1)
+            repr += f"{line}\t{round(self.sleeping_hours(row), 1)}\n{cmdline}"
         return repr + "\n"
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Log the processes of all "
+                                     "users, and email users with sleeping "
+                                     "processes that use a lot of memory.")
+    parser.add_argument("--daemon", action="store_true",
+                        help="keep running and sample every interval")
+    parser.add_argument("--interval", type=float, default=DAEMON_INTERVAL,
+                        help="seconds between samples in daemon mode")
+    parser.add_argument("--sleep-ram", type=float, default=SLEEP_RAM_CUTOFF,
+                        help="%% RAM above which sleeping processes are "
+                        "reported in daemon mode")
+    parser.add_argument("--sleep-hours", type=float, default=SLEEP_HOURS,
+                        help="hours after which sleeping processes are "
+                        "reported in daemon mode")
+    parser.add_argument("--collect", action="store_true",
+                        help="collect the history of all hosts, and email "
+                        "users once for all hosts")
+    parser.add_argument("--no-email", action="store_true",
+                        help="don't email users from this host (use on "
+                        "nodes that report to a collector)")
+    parser.add_argument("--root", default=SLEEPLOG_ROOT,
+                        help="folder with the logs of all hosts")
+    parser.add_argument("--query", action="store_true",
+                        help="aggregate the history instead of sampling")
+    parser.add_argument("--since", type=datetime.datetime.fromisoformat,
+                        help="query from this time (YYYY-MM-DD[THH:MM])")
+    parser.add_argument("--until", type=datetime.datetime.fromisoformat,
+                        help="query until this time (YYYY-MM-DD[THH:MM])")
+    parser.add_argument("--user", help="query only this user")
+    parser.add_argument("--host", help="query only this host, or the name "
+                        "to log this host as")
+    parser.add_argument("--by", choices=["user", "host", "day", "hour"],
+                        default="user", help="group the query by")
+    args = parser.parse_args()
+
+    SLEEPLOG_ROOT = args.root
+    if args.host is not None and not args.query:
+        HOST = args.host
+    LOG_ROOT = f"{SLEEPLOG_ROOT}/{HOST}"
+
+    if args.query:
+        groups = query(args.since, args.until, args.user, args.host, args.by)
+        _print_query(groups, args.by)
+    elif args.collect:
+        collect(args.interval)
+    elif args.daemon:
+        daemon(args.interval, args.sleep_ram, args.sleep_hours,
+               not args.no_email)
+    else:
+        main(not args.no_email)
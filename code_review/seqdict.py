@@ -1,5 +1,168 @@
+import mmap
+import os
+import re
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
+from functools import singledispatch
+from io import TextIOWrapper
+from itertools import chain, islice
+
+import pyfaidx
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+from genomepy import Genome
+
 # Regular expression to check for region (chr:start-end or genome@chr:start-end)
 region_p = re.compile(r"^[^@]+@([^\s]+):(\d+)-(\d+)$")
+plain_region_p = re.compile(r"^([^\s@]+):(\d+)-(\d+)$")
+
+# Regions on the same chromosome that are closer together than FETCH_GAP are read
+# from the genome in a single fetch, as long as that fetch stays below FETCH_SIZE.
+FETCH_GAP = 100_000
+FETCH_SIZE = 10_000_000
+
+# Number of regions iter_seqs fetches from the genome at a time
+ITER_CHUNKSIZE = 10_000
+
+# Formats found by detect_format, by (path, mtime, size)
+_format_cache = {}
+
+
+class LazySeqDict(Mapping):
+    """
+    Read-only dictionary of a faidx-indexed FASTA file.
+
+    Only the names and offsets of the sequences are kept in memory, a sequence
+    is read from the memory-mapped file when it is accessed. The keys are the
+    same as those of pyfaidx (the first word of the header). The index is made
+    with pyfaidx if it does not exist yet.
+    """
+
+    def __init__(self, fname):
+        if fname.endswith(".gz"):
+            raise ValueError("lazy loading needs an uncompressed FASTA file")
+        if not os.path.exists(f"{fname}.fai"):
+            pyfaidx.Faidx(fname)
+
+        self.filename = fname
+        self._index = {}
+        with open(f"{fname}.fai") as fai:
+            for line in fai:
+                name, length, offset, line_bases, line_width = line.split("\t")[:5]
+                self._index[name] = (
+                    int(length),
+                    int(offset),
+                    int(line_bases),
+                    int(line_width),
+                )
+
+        with open(fname, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @property
+    def lengths(self):
+        """
+        Dict with the length of each sequence, without reading any sequence.
+        """
+        return {name: index[0] for name, index in self._index.items()}
+
+    def __getitem__(self, name):
+        length, offset, line_bases, line_width = self._index[name]
+        full_lines, remainder = divmod(length, line_bases)
+        end = offset + full_lines * line_width + remainder
+        seq = self._mmap[offset:end].replace(b"\n", b"").replace(b"\r", b"")
+        return seq.decode()
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __repr__(self):
+        return f"<LazySeqDict {self.filename}: {len(self)} sequences>"
+
+
+class EncodedSeqs:
+    """
+    Sequences encoded as integers (A, C, G and T as 0-3, anything else as N: 4),
+    stored back to back in a single uint8 array. Sequence i is
+    codes[offsets[i] : offsets[i + 1]] and has name names[i].
+    """
+
+    def __init__(self, names, codes, offsets):
+        self.names = names
+        self.codes = codes
+        self.offsets = offsets
+
+    @property
+    def lengths(self):
+        """
+        Dict with the length of each sequence.
+        """
+        return dict(zip(self.names, (self.offsets[1:] - self.offsets[:-1]).tolist()))
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, i):
+        return self.codes[self.offsets[i] : self.offsets[i + 1]]
+
+    def __repr__(self):
+        return f"<EncodedSeqs: {len(self)} sequences, {len(self.codes)} bases>"
+
+    def one_hot(self):
+        """
+        One-hot encode the sequences, with all zeros for N. All sequences need
+        to have the same length.
+
+        Returns
+        -------
+            numpy.ndarray of shape (number of sequences, length, 4)
+        """
+        import numpy as np
+
+        lengths = self.offsets[1:] - self.offsets[:-1]
+        if len(lengths) and (lengths != lengths[0]).any():
+            raise ValueError("one-hot encoding needs sequences of the same length")
+        width = int(lengths[0]) if len(lengths) else 0
+        codes = self.codes.reshape(len(self), width)
+        return np.eye(5, 4, dtype=np.uint8)[codes]
+
+
+def _encoding_table():
+    """
+    Lookup table from ascii to A, C, G, T (upper and lower case) as 0-3 and
+    anything else as N: 4.
+    """
+    import numpy as np
+
+    table = np.full(256, 4, dtype=np.uint8)
+    table[list(b"ACGT")] = table[list(b"acgt")] = np.arange(4)
+    return table
+
+
+def _encode(fa, encoding):
+    """
+    Convert a dictionary of sequences to the requested encoding:
+    None (as is), "uint8" (EncodedSeqs) or "onehot" (names, one-hot array).
+    """
+    if encoding is None:
+        return fa
+    if not isinstance(fa, EncodedSeqs):
+        import numpy as np
+
+        names = list(fa)
+        seqs = [fa[name] for name in names]
+        offsets = np.zeros(len(seqs) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(seq) for seq in seqs])
+        codes = _encoding_table()[np.frombuffer("".join(seqs).encode(), np.uint8)]
+        fa = EncodedSeqs(names, codes, offsets)
+
+    if encoding == "uint8":
+        return fa
+    if encoding == "onehot":
+        return fa.names, fa.one_hot()
+    raise ValueError(f"unknown encoding {encoding}, use uint8 or onehot")
 
 
 def _check_minsize(fa, minsize):
@@ -8,60 +171,253 @@ def _check_minsize(fa, minsize):
     If minsize is None the size will not be checked.
     """
     if minsize is not None:
-        for name, seq in fa.items():
-            if len(seq) < minsize:
+        if isinstance(fa, (LazySeqDict, EncodedSeqs)):
+            lengths = fa.lengths.items()
+        else:
+            lengths = ((name, len(seq)) for name, seq in fa.items())
+        for name, length in lengths:
+            if length < minsize:
                 raise ValueError(f"sequence {name} is shorter than {minsize}")
     return fa
 
 
-def _genomepy_convert(to_convert, genome, minsize=None):
+def _is_comment(line):
     """
-    Convert a variety of inputs using track2fasta().
+    Whether a line of a FASTA, region or BED file has no content.
+    """
+    return not line.strip() or line.startswith(("#", "track", "browser"))
+
+
+def _line_format(line):
+    """
+    Determine the format of a file from its first line that is not a comment.
+
+    Returns "fasta", "genome_region" (genome@chrom:start-end), "region"
+    (chrom:start-end), "narrowpeak" or "bed".
+    """
+    line = line.strip()
+    if line.startswith(">"):
+        return "fasta"
+    if region_p.match(line):
+        return "genome_region"
+    if plain_region_p.match(line):
+        return "region"
+
+    fields = line.split("\t")
+    if len(fields) >= 3 and fields[1].isdigit() and fields[2].isdigit():
+        if len(fields) == 10 and fields[9].lstrip("-").isdigit():
+            return "narrowpeak"
+        return "bed"
+    raise ValueError(f"unknown format, line: {line}")
+
+
+def detect_format(fname):
+    """
+    Determine the format of a file (see _line_format) by only reading up to its
+    first line that is not a comment.
+
+    The result is cached by path, modification time and size, so repeated calls
+    on the same file do not touch its content.
+    """
+    stat = os.stat(fname)
+    key = (os.path.abspath(fname), stat.st_mtime_ns, stat.st_size)
+    if key not in _format_cache:
+        with open(fname) as f:
+            for line in f:
+                if not _is_comment(line):
+                    break
+            else:
+                raise IOError(f"empty file {fname}")
+        _format_cache[key] = _line_format(line)
+    return _format_cache[key]
+
+
+def _region_blocks(regions):
+    """
+    Group a list of regions (chrom:start-end) by chromosome, sort them by start,
+    and split them into blocks of nearby regions that can be read from the
+    genome with a single fetch.
+
+    Yields (chrom, block start, block end, [(start, end, index in regions)]).
+    """
+    by_chrom = {}
+    for i, region in enumerate(regions):
+        chrom, coords = region.rsplit(":", 1)
+        start, end = coords.split("-")
+        by_chrom.setdefault(chrom, []).append((int(start), int(end), i))
+
+    for chrom, coords in by_chrom.items():
+        coords.sort()
+        block, block_end = [], 0
+        for start, end, i in coords:
+            if block and (
+                start - block_end > FETCH_GAP or end - block[0][0] > FETCH_SIZE
+            ):
+                yield chrom, block[0][0], block_end, block
+                block = []
+            if not block:
+                block_end = end
+            block.append((start, end, i))
+            block_end = max(block_end, end)
+        yield chrom, block[0][0], block_end, block
+
+
+def _fetch_regions(g, regions):
+    """
+    Fetch the sequences of a list of regions (chrom:start-end) from a genome.
+
+    Regions are grouped by chromosome and sorted by start, and each run of nearby
+    regions is read with a single fetch and then sliced. Returns a dict with the
+    regions as keys, in input order.
+    """
+    seqs = [None] * len(regions)
+    for chrom, block_start, block_end, block in _region_blocks(regions):
+        seq = str(g[chrom][block_start:block_end])
+        for start, end, i in block:
+            seqs[i] = seq[start - block_start : end - block_start]
+
+    return dict(zip(regions, seqs))
+
+
+def _fetch_regions_encoded(g, regions):
+    """
+    Fetch the sequences of a list of regions (chrom:start-end) from a genome as
+    EncodedSeqs, in the same blocks as _fetch_regions. Each block is encoded at
+    once and copied into place, without making a string per region.
+    """
+    import numpy as np
+
+    table = _encoding_table()
+    blocks = list(_region_blocks(regions))
+
+    # the length of each region, regions are cut off at the end of the chromosome
+    chrom_sizes = {chrom: len(g[chrom]) for chrom in {block[0] for block in blocks}}
+    lengths = np.zeros(len(regions), dtype=np.int64)
+    for chrom, _, _, block in blocks:
+        for start, end, i in block:
+            lengths[i] = max(min(end, chrom_sizes[chrom]) - start, 0)
+    offsets = np.zeros(len(regions) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(lengths)
+
+    codes = np.empty(offsets[-1], dtype=np.uint8)
+    for chrom, block_start, block_end, block in blocks:
+        seq = str(g[chrom][block_start:block_end]).encode()
+        seq = table[np.frombuffer(seq, dtype=np.uint8)]
+
+        starts, _, idxs = np.array(block, dtype=np.int64).T
+        block_lengths = lengths[idxs]
+        within = np.arange(block_lengths.sum()) - np.repeat(
+            np.cumsum(block_lengths) - block_lengths, block_lengths
+        )
+        codes[np.repeat(offsets[idxs], block_lengths) + within] = seq[
+            np.repeat(starts - block_start, block_lengths) + within
+        ]
+
+    return EncodedSeqs(list(regions), codes, offsets)
+
+
+def _genomepy_convert(to_convert, genome, minsize=None, encoding=None):
+    """
+    Convert a list of regions (chrom:start-end) by fetching them directly from
+    the genome.
     """
     if genome is None:
         raise ValueError("input file is not a FASTA file, need a genome!")
 
     g = Genome(genome)
-    tmpfile = NamedTemporaryFile()
-    g.track2fasta(to_convert, tmpfile.name)
+    regions = [region.strip() for region in to_convert]
+    if encoding is not None:
+        fa = _fetch_regions_encoded(g, regions)
+        return _encode(_check_minsize(fa, minsize), encoding)
 
-    fa = as_seqdict(tmpfile.name)
+    fa = _fetch_regions(g, regions)
     return _check_minsize(fa, minsize)
 
 
-def _as_seqdict_genome_regions(regions, minsize=None):
+# Genomes opened by a worker process of _as_seqdict_genome_regions, these stay
+# open for the next batch of regions the worker gets.
+_worker_genomes = {}
+
+# Process pool that fetches the regions of several genomes. It is kept between
+# calls, so its workers keep their Genome handles (_worker_genomes) open.
+_pool = None
+_pool_size = 0
+
+
+def _get_pool(ncpus):
+    """
+    Return the process pool, (re)started if it does not have ncpus workers.
+    """
+    global _pool, _pool_size
+    if _pool is None or _pool_size != ncpus:
+        if _pool is not None:
+            _pool.shutdown()
+        _pool = ProcessPoolExecutor(ncpus)
+        _pool_size = ncpus
+    return _pool
+
+
+def _fetch_genome_regions(genome, regions):
+    """
+    Fetch a batch of regions of one genome, in a worker process of the pool.
+    """
+    if genome not in _worker_genomes:
+        _worker_genomes[genome] = Genome(genome)
+    return _fetch_regions(_worker_genomes[genome], regions)
+
+
+def _as_seqdict_genome_regions(regions, minsize=None, ncpus=1, genomes=None):
     """
     Accepts list of regions where the genome is encoded in the region,
     using the genome@chrom:start-end format.
+
+    genomes is a dict of Genome handles by name, that is filled as needed and
+    can be passed again to reuse the handles in the next call.
+
+    If ncpus is larger than 1 and there is more than one genome, the regions
+    of each genome are fetched concurrently in a pool of ncpus processes, that
+    is reused by later calls.
     """
     genomic_regions = {}
     for region in regions:
         genome, region = region.split("@")
         if genome not in genomic_regions:
-            Genome(genome)
             genomic_regions[genome] = []
         genomic_regions[genome].append(region)
 
-    tmpfa = NamedTemporaryFile(mode="w", delete=False)
-    for genome, g_regions in genomic_regions.items():
-        g = Genome(genome)
-
-        fa = g.track2fasta(g_regions)
-
-        for seq in fa:
-            seq.name = f"{genome}@{seq.name}"
-            print(seq.__repr__(), file=tmpfa)
-
-    tmpfa.flush()
-
-    # Open tempfile and restore original sequence order
-    fa = as_seqdict(tmpfa.name)
+    if ncpus > 1 and len(genomic_regions) > 1:
+        results = _get_pool(ncpus).map(
+            _fetch_genome_regions, genomic_regions, genomic_regions.values()
+        )
+        results = dict(zip(genomic_regions, results))
+    else:
+        if genomes is None:
+            genomes = {}
+        results = {}
+        for genome, g_regions in genomic_regions.items():
+            if genome not in genomes:
+                genomes[genome] = Genome(genome)
+            results[genome] = _fetch_regions(genomes[genome], g_regions)
+
+    fa = {}
+    for genome, g_fa in results.items():
+        for region, seq in g_fa.items():
+            fa[f"{genome}@{region}"] = seq
+
+    # Restore original sequence order
     fa = {region: fa[region] for region in regions}
     return _check_minsize(fa, minsize)
 
 
 @singledispatch
-def as_seqdict(to_convert, genome=None, minsize=None):
+def as_seqdict(
+    to_convert,
+    genome=None,
+    minsize=None,
+    lazy=False,
+    ncpus=1,
+    encoding=None,
+):
     """
     Convert input to a dictionary with name as key and sequence as value.
 
@@ -88,90 +444,140 @@ def as_seqdict(to_convert, genome=None, minsize=None):
     minsize : int or None, optional
         If specified, check if all sequences have at least size minsize.
 
+    lazy : bool, optional
+        Return a LazySeqDict instead of a dict for FASTA files and pyfaidx.Fasta
+        objects. Sequences are then only read when they are accessed. Keys
+        are the first word of the FASTA header, like pyfaidx. Ignored for
+        other inputs.
+
+    ncpus : int, optional
+        Number of processes used to fetch regions in the genome@chrom:start-end
+        format when they come from more than one genome.
+
+    encoding : str, optional
+        Instead of a dict return the sequences as integers (A, C, G, T and N as
+        0-4). With "uint8" an EncodedSeqs with all sequences back to back in a
+        single array, with "onehot" a tuple of the names and a one-hot array of
+        shape (sequences, length, 4) if all sequences have the same length.
+        Regions are encoded directly from the genome, without making a string
+        for each sequence.
+
     Returns
     -------
-        dict with sequence names as key and sequences as value.
+        dict (or LazySeqDict) with sequence names as key and sequences as value,
+        or the encoded sequences if an encoding is given.
     """
     raise NotImplementedError(f"Not implement for {type(to_convert)}")
 
 
 @as_seqdict.register(list)
-def _as_seqdict_list(to_convert, genome=None, minsize=None):
+def _as_seqdict_list(
+    to_convert,
+    genome=None,
+    minsize=None,
+    lazy=False,
+    ncpus=1,
+    encoding=None,
+):
     """
     Accepts list of regions as input.
     """
     if region_p.match(to_convert[0]):
-        return _as_seqdict_genome_regions(to_convert, minsize)
+        fa = _as_seqdict_genome_regions(to_convert, minsize, ncpus)
+        return _encode(fa, encoding)
 
-    return _genomepy_convert(to_convert, genome, minsize)
+    return _genomepy_convert(to_convert, genome, minsize, encoding)
 
 
 @as_seqdict.register(TextIOWrapper)
-def _as_seqdict_file_object(to_convert, genome=None, minsize=None):
+def _as_seqdict_file_object(
+    to_convert,
+    genome=None,
+    minsize=None,
+    lazy=False,
+    ncpus=1,
+    encoding=None,
+):
     """
     Accepts file object as input, should be a FASTA file.
     """
     fa = {x: y for x, y in SimpleFastaParser(to_convert)}
-    return _check_minsize(fa, minsize)
+    return _encode(_check_minsize(fa, minsize), encoding)
 
 
 @as_seqdict.register(str)
-def _as_seqdict_filename(to_convert, genome=None, minsize=None):
+def _as_seqdict_filename(
+    to_convert,
+    genome=None,
+    minsize=None,
+    lazy=False,
+    ncpus=1,
+    encoding=None,
+):
     """
     Accepts filename as input.
     """
     if not os.path.exists(to_convert):
         raise ValueError("Assuming filename, but it does not exist")
 
-    f = open(to_convert)
-    fa = as_seqdict(f)
-
-    if any(fa):
-        return _check_minsize(fa, minsize)
+    file_format = detect_format(to_convert)
+    if file_format == "fasta":
+        if lazy:
+            fa = LazySeqDict(to_convert)
+        else:
+            with open(to_convert) as f:
+                fa = as_seqdict(f)
+        return _encode(_check_minsize(fa, minsize), encoding)
 
     with open(to_convert) as f:
-        line = ""
-        while True:
-            line = f.readline()
-            if line == "":
-                break
-            if not line.startswith("#"):
-                break
-
-        if line == "":
-            raise IOError(f"empty file {to_convert}")
+        regions = [_line_to_region(line) for line in f if not _is_comment(line)]
 
-        if region_p.match(line.strip()):
-            regions = [region.strip() for region in [line] + f.readlines()]
-            return _as_seqdict_genome_regions(regions, minsize=None)
+    if file_format == "genome_region":
+        fa = _as_seqdict_genome_regions(regions, minsize, ncpus)
+        return _encode(fa, encoding)
 
-    # Biopython parser resulted in empty dict
-    # Assuming it's a BED or region file
-    return _genomepy_convert(to_convert, genome, minsize)
+    # region, BED and narrowPeak files
+    return _genomepy_convert(regions, genome, minsize, encoding)
 
 
 @as_seqdict.register(pyfaidx.Fasta)
-def _as_seqdict_pyfaidx(to_convert, genome=None, minsize=None):
+def _as_seqdict_pyfaidx(
+    to_convert,
+    genome=None,
+    minsize=None,
+    lazy=False,
+    ncpus=1,
+    encoding=None,
+):
     """
     Accepts pyfaidx.Fasta object as input.
     """
-    fa = {k: str(v) for k, v in to_convert.items()}
-    return _check_minsize(fa, minsize)
+    if lazy:
+        fa = LazySeqDict(to_convert.filename)
+    else:
+        fa = {k: str(v) for k, v in to_convert.items()}
+    return _encode(_check_minsize(fa, minsize), encoding)
 
 
 try:
     import pybedtools
 
     @as_seqdict.register(pybedtools.BedTool)
-    def _as_seqdict_bedtool(to_convert, genome=None, minsize=None):
+    def _as_seqdict_bedtool(
+        to_convert,
+        genome=None,
+        minsize=None,
+        lazy=False,
+        ncpus=1,
+        encoding=None,
+    ):
         """
         Accepts pybedtools.BedTool as input.
         """
         return _genomepy_convert(
-            ["{}:{}-{}".format(*f[:3]) for f in to_convert], genome, minsize
+            ["{}:{}-{}".format(*f[:3]) for f in to_convert], genome, minsize, encoding
         )
 
-
 except ImportError:
     pass
 
@@ -179,12 +585,190 @@ try:
     import numpy as np
 
     @as_seqdict.register(np.ndarray)
-    def _as_seqdict_array(to_convert, genome=None, minsize=None):
+    def _as_seqdict_array(
+        to_convert,
+        genome=None,
+        minsize=None,
+        lazy=False,
+        ncpus=1,
+        encoding=None,
+    ):
         """
         Accepts numpy.ndarray with regions as input.
         """
-        return as_seqdict(list(to_convert), genome, minsize)
+        return as_seqdict(
+            list(to_convert), genome, minsize, ncpus=ncpus, encoding=encoding
+        )
+
+except ImportError:
+    pass
+
+
+def _check_minsize_iter(seqs, minsize):
+    """
+    Pass through (name, seq) pairs, and raise ValueError at the first sequence
+    that is shorter than minsize. If minsize is None the size will not be checked.
+    """
+    for name, seq in seqs:
+        if minsize is not None and len(seq) < minsize:
+            raise ValueError(f"sequence {name} is shorter than {minsize}")
+        yield name, seq
+
+
+def _line_to_region(line):
+    """
+    Convert a line of a region or BED file to a region (chrom:start-end or
+    genome@chrom:start-end).
+    """
+    line = line.strip()
+    if region_p.match(line) or plain_region_p.match(line):
+        return line
+    chrom, start, end = line.split("\t")[:3]
+    return f"{chrom}:{start}-{end}"
+
+
+def _iter_regions(regions, genome=None, ncpus=1):
+    """
+    Fetch an iterable of regions ITER_CHUNKSIZE at a time, and yield the
+    (region, seq) pairs in input order.
+
+    Genome handles are kept for the whole iteration, and with ncpus > 1 all
+    chunks are fetched by the same process pool.
+    """
+    regions = iter(regions)
+    g = None
+    genomes = {}
+    while True:
+        chunk = list(islice(regions, ITER_CHUNKSIZE))
+        if len(chunk) == 0:
+            return
+
+        if region_p.match(chunk[0]):
+            fa = _as_seqdict_genome_regions(chunk, ncpus=ncpus, genomes=genomes)
+        else:
+            if genome is None:
+                raise ValueError("input file is not a FASTA file, need a genome!")
+            if g is None:
+                g = Genome(genome)
+            fa = _fetch_regions(g, chunk)
+
+        for region in chunk:
+            yield region, fa[region]
+
+
+@singledispatch
+def iter_seqs(to_convert, genome=None, minsize=None, ncpus=1):
+    """
+    Iterate over (name, sequence) pairs of the input, without loading all of
+    it into memory.
+
+    The same inputs are supported as as_seqdict. FASTA input is parsed one
+    record at a time, and regions (or BED lines) are fetched from the genome
+    ITER_CHUNKSIZE at a time, so memory use does not depend on the size of the
+    input. Files are only read once: the format is determined from the first
+    line that is not a comment.
+
+    Parameters
+    ----------
+    to_convert : list, str, file object, pyfaidx.Fasta or pybedtools.BedTool
+        Input to iterate over.
+
+    genome : str, optional
+        Genomepy genome name.
+
+    minsize : int or None, optional
+        If specified, raise a ValueError as soon as a sequence is shorter
+        than minsize. Sequences before it have already been yielded.
+
+    ncpus : int, optional
+        Number of processes used to fetch regions in the genome@chrom:start-end
+        format when they come from more than one genome.
+
+    Yields
+    ------
+        tuple of (name, sequence)
+    """
+    raise NotImplementedError(f"Not implement for {type(to_convert)}")
+
+
+@iter_seqs.register(list)
+def _iter_seqs_list(to_convert, genome=None, minsize=None, ncpus=1):
+    """
+    Accepts list of regions as input.
+    """
+    regions = (region.strip() for region in to_convert)
+    return _check_minsize_iter(_iter_regions(regions, genome, ncpus), minsize)
+
+
+@iter_seqs.register(TextIOWrapper)
+def _iter_seqs_file_object(to_convert, genome=None, minsize=None, ncpus=1):
+    """
+    Accepts file object of a FASTA, region or BED file as input.
+    """
+    for line in to_convert:
+        if not _is_comment(line):
+            break
+    else:
+        return
+
+    # put the first line back in front of the rest of the file
+    lines = chain([line], to_convert)
+    if _line_format(line) == "fasta":
+        seqs = SimpleFastaParser(lines)
+    else:
+        regions = (_line_to_region(line) for line in lines if not _is_comment(line))
+        seqs = _iter_regions(regions, genome, ncpus)
+
+    yield from _check_minsize_iter(seqs, minsize)
+
+
+@iter_seqs.register(str)
+def _iter_seqs_filename(to_convert, genome=None, minsize=None, ncpus=1):
+    """
+    Accepts filename as input.
+    """
+    if not os.path.exists(to_convert):
+        raise ValueError("Assuming filename, but it does not exist")
+
+    def seqs():
+        with open(to_convert) as f:
+            yield from _iter_seqs_file_object(f, genome, minsize, ncpus)
+
+    return seqs()
+
+
+@iter_seqs.register(pyfaidx.Fasta)
+def _iter_seqs_pyfaidx(to_convert, genome=None, minsize=None, ncpus=1):
+    """
+    Accepts pyfaidx.Fasta object as input.
+    """
+    seqs = ((k, str(v)) for k, v in to_convert.items())
+    return _check_minsize_iter(seqs, minsize)
+
+
+try:
+    import pybedtools
+
+    @iter_seqs.register(pybedtools.BedTool)
+    def _iter_seqs_bedtool(to_convert, genome=None, minsize=None, ncpus=1):
+        """
+        Accepts pybedtools.BedTool as input.
+        """
+        regions = ("{}:{}-{}".format(*f[:3]) for f in to_convert)
+        return _check_minsize_iter(_iter_regions(regions, genome, ncpus), minsize)
+
+except ImportError:
+    pass
+
+try:
+    import numpy as np
 
+    @iter_seqs.register(np.ndarray)
+    def _iter_seqs_array(to_convert, genome=None, minsize=None, ncpus=1):
+        """
+        Accepts numpy.ndarray with regions as input.
+        """
+        return iter_seqs(list(to_convert), genome, minsize, ncpus)
 
 except ImportError:
     pass